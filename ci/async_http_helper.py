@@ -0,0 +1,600 @@
+from constants import GITHUB_API_URL
+from environment import \
+    oauth_token, \
+    oauth_tokens, \
+    GITHUB_POOL_SIZE, \
+    GITHUB_KEEP_ALIVE, \
+    GITHUB_CACHE_SIZE, \
+    GITHUB_PAGE_PARALLELISM, \
+    GITHUB_RATE_LIMIT_MAX_WAIT_IN_SECONDS
+from concurrent.futures import ThreadPoolExecutor
+from rate_limit import RateLimitScheduler, STATUS, WEBHOOK, priority_names, token_label
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+import aiohttp
+import asyncio
+import collections
+import json as json_module
+import re
+import threading
+import time
+
+# This is the only implementation of the GitHub client; http_helper is a
+# blocking facade over it. All coroutines in this module run on one event
+# loop owned by a daemon thread, so blocking code (flask handlers, the polling
+# loop) can fan out many GitHub requests at once with run or run_all and wait
+# for them together.
+
+loop = asyncio.new_event_loop()
+loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+loop_thread.start()
+
+
+def run(coro):
+    # waiting on the loop from the loop would never return
+    assert threading.current_thread() is not loop_thread
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+# if parallelism is given, at most that many of coros run at once
+def run_all(coros, return_exceptions=False, parallelism=None):
+    async def gather():
+        if parallelism is None:
+            limited = coros
+        else:
+            semaphore = asyncio.Semaphore(parallelism)
+
+            async def limit(coro):
+                async with semaphore:
+                    return await coro
+            limited = [limit(coro) for coro in coros]
+        return await asyncio.gather(*limited, return_exceptions=return_exceptions)
+    return run(gather())
+
+
+class BadStatus(Exception):
+    def __init__(self, data, status_code):
+        Exception.__init__(self, str(data))
+        self.data = data
+        self.status_code = status_code
+
+
+class CallTimings(object):
+    def __init__(self, max_recent=100):
+        self._lock = threading.Lock()
+        self._by_verb = {}
+        self._recent = collections.deque(maxlen=max_recent)
+
+    def record(self, verb, url, status_code, seconds):
+        with self._lock:
+            t = self._by_verb.get(verb, None)
+            if t is None:
+                t = {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+                self._by_verb[verb] = t
+            t['calls'] += 1
+            t['total_seconds'] += seconds
+            t['max_seconds'] = max(t['max_seconds'], seconds)
+            self._recent.append({
+                'verb': verb,
+                'url': url,
+                'status_code': status_code,
+                'seconds': seconds
+            })
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'by_verb': {
+                    verb: dict(t, mean_seconds=t['total_seconds'] / t['calls'])
+                    for verb, t in self._by_verb.items()
+                },
+                'recent': list(self._recent)
+            }
+
+
+class AsyncResponse(object):
+    def __init__(self, status_code, headers, text):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def json(self):
+        return json_module.loads(self.text)
+
+
+class PooledSession(object):
+    # one aiohttp session, and so one pool of keep-alive connections, shared
+    # by every request. It is created lazily because it must be created on
+    # the event loop.
+    def __init__(self, pool_size, keep_alive, timeout_in_seconds=5):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.timeout_in_seconds = timeout_in_seconds
+        self.timings = CallTimings()
+        self._session = None
+
+    def session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                force_close=not self.keep_alive)
+            # like requests' timeout, this bounds each connect and each read;
+            # a total timeout would also count the time spent waiting for a
+            # free connection in the pool
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=self.timeout_in_seconds,
+                    sock_read=self.timeout_in_seconds))
+        return self._session
+
+    async def request(self, verb, url, **kwargs):
+        start = time.time()
+        async with self.session().request(verb, url, **kwargs) as r:
+            text = await r.text()
+            response = AsyncResponse(r.status, r.headers, text)
+        self.timings.record(verb, url, r.status, time.time() - start)
+        return response
+
+    def to_json(self):
+        return {
+            'pool_size': self.pool_size,
+            'keep_alive': self.keep_alive,
+            'timings': self.timings.to_json()
+        }
+
+
+class CachedResponse(object):
+    def __init__(self, etag, last_modified, link, text):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.link = link
+        self.text = text
+        self.status_code = 200
+        self.headers = {} if link is None else {'Link': link}
+
+    def json(self):
+        # parse anew every time, callers are free to mutate what they get
+        return json_module.loads(self.text)
+
+
+class ConditionalCache(object):
+    # 304 Not Modified responses do not count against the GitHub rate limit,
+    # so we remember the validators and body of every GET and replay the body
+    # when GitHub tells us nothing changed
+    def __init__(self, max_entries, shared_tokens):
+        self.max_entries = max_entries
+        # responses fetched with any of these tokens are interchangeable
+        self.shared_tokens = shared_tokens
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def _key(self, url, token):
+        if token in self.shared_tokens:
+            return (url, None)
+        return (url, token)
+
+    def lookup(self, url, token):
+        with self._lock:
+            return self._entries.get(self._key(url, token), None)
+
+    def conditional_headers(self, cached):
+        headers = {}
+        if cached.etag is not None:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified is not None:
+            headers['If-Modified-Since'] = cached.last_modified
+        return headers
+
+    def hit(self, url, token):
+        with self._lock:
+            self.hits += 1
+            key = self._key(url, token)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def store(self, url, token, r):
+        with self._lock:
+            self.misses += 1
+            key = self._key(url, token)
+            if self.max_entries == 0 or r.status_code != 200:
+                return
+            etag = r.headers.get('ETag', None)
+            last_modified = r.headers.get('Last-Modified', None)
+            if etag is None and last_modified is None:
+                self._entries.pop(key, None)
+                return
+            self._entries[key] = CachedResponse(
+                etag, last_modified, r.headers.get('Link', None), r.text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'max_entries': self.max_entries,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class TokenPool(object):
+    def __init__(self, tokens, write_token, scheduler):
+        self.tokens = tokens
+        self.write_token = write_token
+        self.scheduler = scheduler
+        self._lock = threading.Lock()
+        self._usage = collections.defaultdict(collections.Counter)
+        self._names = {token: name for name, token in tokens.items()}
+        scheduler.labels.update(self._names)
+
+    def read_token(self, resource):
+        # a token we have never used has an unknown, presumably full, budget
+        def remaining(token):
+            budget = self.scheduler.budget(token, resource)
+            return float('inf') if budget is None else budget
+        return max(self.tokens.values(), key=remaining)
+
+    def token_for(self, verb, url):
+        resource = resource_for_url(url)
+        if verb == 'get' or resource == 'graphql':
+            return self.read_token(resource)
+        else:
+            return self.write_token
+
+    def record(self, token, verb):
+        with self._lock:
+            self._usage[self._names.get(token, token_label(token))][verb] += 1
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'write_token': self._names[self.write_token],
+                'usage': {name: dict(usage) for name, usage in self._usage.items()}
+            }
+
+
+github_session = PooledSession(GITHUB_POOL_SIZE, GITHUB_KEEP_ALIVE)
+github_cache = ConditionalCache(GITHUB_CACHE_SIZE, set(oauth_tokens.values()))
+github_scheduler = RateLimitScheduler(GITHUB_RATE_LIMIT_MAX_WAIT_IN_SECONDS)
+github_tokens = TokenPool(oauth_tokens, oauth_token, github_scheduler)
+# acquire blocks while a request waits for its budget. Each priority waits on
+# its own threads, so a merge never queues behind webhook reads that are
+# waiting out their reserve before it even reaches the scheduler.
+acquire_pools = {
+    priority: ThreadPoolExecutor(max_workers=GITHUB_POOL_SIZE)
+    for priority in priority_names
+}
+
+
+def http_stats():
+    return {
+        'session': github_session.to_json(),
+        'cache': github_cache.to_json(),
+        'rate_limit': github_scheduler.to_json(),
+        'tokens': github_tokens.to_json()
+    }
+
+
+def resource_for_url(url):
+    if url == f'{GITHUB_API_URL}graphql':
+        return 'graphql'
+    else:
+        return 'core'
+
+
+async def send(verb, url, token, priority, **kwargs):
+    resource = resource_for_url(url)
+    # acquire may sleep until the budget allows the request
+    await loop.run_in_executor(
+        acquire_pools[priority], github_scheduler.acquire, token, priority, resource)
+    github_tokens.record(token, verb)
+    r = await github_session.request(verb, url, **kwargs)
+    github_scheduler.update(token, r, resource)
+    return r
+
+
+async def get_with_cache(url, headers, token, priority):
+    cached = github_cache.lookup(url, token)
+    if cached is not None:
+        headers = dict(headers, **github_cache.conditional_headers(cached))
+    r = await send('get', url, token, priority, headers=headers)
+    if r.status_code == 304 and cached is not None:
+        github_cache.hit(url, token)
+        return cached
+    github_cache.store(url, token, r)
+    return r
+
+
+# yields (url, response) for each page after the one whose Link header is
+# link, in order. Unless prefetch is False, and if GitHub says which page is
+# the last, a few pages are fetched ahead of the one being yielded.
+async def iter_remaining_pages(link, headers, token, priority, prefetch=True):
+    links = github_link_header_to_links(link)
+    next_url = links.get('next', None)
+    last_url = links.get('last', None)
+    if prefetch and next_url is not None and last_url is not None:
+        # rel="last" tells us every remaining page up front, so there is no
+        # need to wait for each page to learn where the next one is
+        urls = collections.deque(page_urls(next_url, last_url))
+        fetching = collections.deque()
+        try:
+            while len(urls) != 0 or len(fetching) != 0:
+                while len(urls) != 0 and len(fetching) < GITHUB_PAGE_PARALLELISM:
+                    url = urls.popleft()
+                    fetching.append(
+                        (url, asyncio.ensure_future(
+                            get_with_cache(url, headers, token, priority))))
+                (url, page) = fetching.popleft()
+                yield (url, await page)
+        finally:
+            # the caller stopped early
+            for (_, page) in fetching:
+                page.cancel()
+        return
+    while next_url is not None:
+        r = await get_with_cache(next_url, headers, token, priority)
+        yield (next_url, r)
+        next_url = github_link_header_to_links(
+            r.headers.get('Link', '')).get('next', None)
+
+
+async def get_remaining_pages(link, headers, token, priority):
+    return [r async for (_, r) in iter_remaining_pages(link, headers, token, priority)]
+
+
+async def patch_repo(repo,
+                     url,
+                     headers=None,
+                     json=None,
+                     data=None,
+                     status_code=None,
+                     json_response=True,
+                     token=None,
+                     priority=None):
+    return await verb_repo(
+        'patch',
+        repo,
+        url,
+        headers=headers,
+        json=json,
+        data=data,
+        status_code=status_code,
+        json_response=json_response,
+        token=token,
+        priority=priority)
+
+
+async def post_repo(repo,
+                    url,
+                    headers=None,
+                    json=None,
+                    data=None,
+                    status_code=None,
+                    json_response=True,
+                    token=None,
+                    priority=None):
+    return await verb_repo(
+        'post',
+        repo,
+        url,
+        headers=headers,
+        json=json,
+        data=data,
+        status_code=status_code,
+        json_response=json_response,
+        token=token,
+        priority=priority)
+
+
+async def get_repo(repo,
+                   url,
+                   headers=None,
+                   status_code=None,
+                   json_response=True,
+                   token=None,
+                   priority=None):
+    return await verb_repo(
+        'get',
+        repo,
+        url,
+        headers=headers,
+        status_code=status_code,
+        json_response=json_response,
+        token=token,
+        priority=priority)
+
+
+async def put_repo(repo,
+                   url,
+                   headers=None,
+                   json=None,
+                   data=None,
+                   status_code=None,
+                   json_response=True,
+                   token=None,
+                   priority=None):
+    return await verb_repo(
+        'put',
+        repo,
+        url,
+        headers=headers,
+        json=json,
+        data=data,
+        status_code=status_code,
+        json_response=json_response,
+        token=token,
+        priority=priority)
+
+
+async def verb_repo(verb,
+                    repo,
+                    url,
+                    headers=None,
+                    json=None,
+                    data=None,
+                    status_code=None,
+                    json_response=True,
+                    token=None,
+                    priority=None):
+    return await verb_github(
+        verb,
+        f'repos/{repo}/{url}',
+        headers=headers,
+        json=json,
+        data=data,
+        status_code=status_code,
+        json_response=json_response,
+        token=token,
+        priority=priority)
+
+
+async def get_github(url, headers=None, status_code=None, priority=None):
+    return await verb_github('get',
+                             url,
+                             headers=headers,
+                             status_code=status_code,
+                             priority=priority)
+
+
+def implies(antecedent, consequent):
+    return not antecedent or consequent
+
+
+verbs = set(['post', 'put', 'get', 'patch'])
+
+
+def authorized_headers(headers, token):
+    if headers is None:
+        headers = {}
+    if 'Authorization' in headers:
+        raise ValueError('Header already has Authorization? ' + str(headers))
+    headers['Authorization'] = 'token ' + token
+    return headers
+
+
+async def verb_github(verb,
+                      url,
+                      headers=None,
+                      json=None,
+                      data=None,
+                      status_code=None,
+                      json_response=True,
+                      token=None,
+                      priority=None):
+    assert verb in verbs, f'{verb} {verbs}'
+    if priority is None:
+        priority = WEBHOOK if verb == 'get' else STATUS
+    assert implies(verb == 'post' or verb == 'put',
+                   json is not None or data is not None)
+    assert implies(verb == 'get', json is None and data is None)
+    full_url = f'{GITHUB_API_URL}{url}'
+    if token is None:
+        token = github_tokens.token_for(verb, full_url)
+    headers = authorized_headers(headers, token)
+    if verb == 'get':
+        r = await get_with_cache(full_url, headers, token, priority)
+        if json_response:
+            output = r.json()
+            if 'Link' in r.headers:
+                assert isinstance(output, list), output
+                pages = await get_remaining_pages(r.headers['Link'],
+                                                  headers,
+                                                  token,
+                                                  priority)
+                for r in pages:
+                    if r.status_code != 200:
+                        output = r.json()
+                        break
+                    output.extend(r.json())
+        else:
+            output = r.text
+    else:
+        r = await send(
+            verb,
+            full_url,
+            token,
+            priority,
+            headers=headers,
+            data=data,
+            json=json)
+        if json_response:
+            output = r.json()
+        else:
+            output = r.text
+    return checked_output(verb,
+                          full_url,
+                          status_code,
+                          r.status_code,
+                          data,
+                          json,
+                          output)
+
+
+def checked_output(verb,
+                   full_url,
+                   status_code,
+                   actual_status_code,
+                   data,
+                   json,
+                   output):
+    if isinstance(status_code, int):
+        status_codes = [status_code]
+    else:
+        status_codes = status_code
+    if status_codes and actual_status_code not in status_codes:
+        raise BadStatus({
+            'method': verb,
+            'endpoint': full_url,
+            'status_code': {
+                'actual': actual_status_code,
+                'expected': status_codes
+            },
+            'message': 'github error',
+            'data': data,
+            'json': json,
+            'github_json': output
+        },
+                        actual_status_code)
+    else:
+        if isinstance(status_code, list):
+            return (output, actual_status_code)
+        else:
+            return output
+
+
+def page_urls(first_url, last_url):
+    return [url_with_page(first_url, page)
+            for page in range(page_number(first_url), page_number(last_url) + 1)]
+
+
+def page_number(url):
+    return int(dict(parse_qsl(urlparse(url).query))['page'])
+
+
+def url_with_page(url, page):
+    parts = urlparse(url)
+    query = dict(parse_qsl(parts.query))
+    query['page'] = str(page)
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+
+github_link = re.compile(r'\s*<(http[^>]+)>; rel="([A-z]+)"\s*')
+
+
+def github_link_header_to_links(link):
+    # I cannot find rigorous documentation on the format, but this seems to
+    # work?
+    links = {}
+    for t in link.split(','):
+        if t.strip() == '':
+            continue
+        m = github_link.match(t)
+        assert m is not None, f'{m} {t}'
+        links[m[2]] = m[1]
+    return links
+
@@ -1,16 +1,87 @@
 from constants import SHA_LENGTH
 from ci_logging import log
+from environment import BATCH_CANCEL_PARALLELISM
 from git_state import FQSHA
-import requests
+import collections
+import concurrent.futures
 import json
+import threading
+
+MAX_RECORDED_FAILURES = 100
+
+
+class JobCancellations(object):
+    # Cancelling a job is a round trip to batch, and a single push can make
+    # dozens of builds obsolete, so cancellations happen on a pool of threads
+    # and callers only wait for them to be queued. A job is deleted once it
+    # is cancelled.
+    def __init__(self, parallelism):
+        self.parallelism = parallelism
+        self.cancelled = 0
+        self.deleted = 0
+        self.failures = collections.deque(maxlen=MAX_RECORDED_FAILURES)
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=parallelism)
+
+    def cancel(self, jobs):
+        new_jobs = []
+        with self._lock:
+            for job in jobs:
+                if job.id not in self._pending:
+                    self._pending.add(job.id)
+                    new_jobs.append(job)
+        for job in new_jobs:
+            self._pool.submit(self._cancel, job)
+
+    def _cancel(self, job):
+        try:
+            job.cancel()
+            with self._lock:
+                self.cancelled += 1
+        except Exception as e:
+            self._failed(job, 'cancel', e)
+            return
+        self._pool.submit(self._delete, job)
+
+    def _delete(self, job):
+        try:
+            job.delete()
+            with self._lock:
+                self.deleted += 1
+                self._pending.discard(job.id)
+        except Exception as e:
+            self._failed(job, 'delete', e)
+
+    def _failed(self, job, action, e):
+        log.warning(f'could not {action} job {job.id} due to {e}')
+        with self._lock:
+            self.failed += 1
+            self.failures.append({'id': job.id, 'action': action, 'error': str(e)})
+            self._pending.discard(job.id)
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'parallelism': self.parallelism,
+                'pending': len(self._pending),
+                'cancelled': self.cancelled,
+                'deleted': self.deleted,
+                'failed': self.failed,
+                'recent_failures': list(self.failures)
+            }
+
+
+job_cancellations = JobCancellations(BATCH_CANCEL_PARALLELISM)
 
 
 def try_to_cancel_job(job):
-    try:
-        job.cancel()
-        job.delete()
-    except requests.exceptions.HTTPError as e:
-        log.warning(f'could not cancel job {job.id} due to {e}')
+    job_cancellations.cancel([job])
+
+
+def try_to_cancel_jobs(jobs):
+    job_cancellations.cancel(jobs)
 
 
 # job_ordering(x, y) > 0 if x is closer to finishing or has a larger id
@@ -55,3 +126,59 @@ def short_str_build_job(job):
         f'{source.short_str()};'
         f'{attr["type"]};{attr["image"]};'
     )
+
+
+def list_jobs_by_type(batch_client, job_types):
+    # the batch server cannot filter on attributes, so every job on the
+    # cluster comes back and we keep only the types we asked for
+    jobs = batch_client.list_jobs()
+    jobs_by_type = {job_type: [] for job_type in job_types}
+    for job in jobs:
+        job_type = job.attributes.get('type', None) if job.attributes else None
+        if job_type in jobs_by_type:
+            jobs_by_type[job_type].append(job)
+    return jobs_by_type
+
+
+def is_finished(job):
+    return job.cached_status()['state'] in ('Complete', 'Cancelled')
+
+
+class ReconciledJobs(object):
+    # finished jobs never change again, so once one has been reconciled
+    # against a known PR there is no need to look at it on the next refresh.
+    # A finished job whose PR we have not heard of yet is not recorded; it is
+    # looked at again until its PR shows up.
+    def __init__(self):
+        self.listed = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._ids = set()
+
+    def new_jobs(self, jobs):
+        with self._lock:
+            new = [job for job in jobs if job.id not in self._ids]
+            self.listed += len(jobs)
+            self.skipped += len(jobs) - len(new)
+            return new
+
+    def record(self, jobs):
+        with self._lock:
+            self._ids.update(job.id for job in jobs if is_finished(job))
+
+    def retain(self, jobs):
+        # deleted jobs are never listed again, so forget them
+        with self._lock:
+            self._ids &= {job.id for job in jobs}
+
+    def clear(self):
+        with self._lock:
+            self._ids = set()
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'reconciled': len(self._ids),
+                'listed': self.listed,
+                'skipped': self.skipped
+            }
@@ -49,6 +49,9 @@ def build_state_from_json(d):
             d['target_sha'])
     elif t == 'Buildable':
         return Buildable(d['image'], d['target_sha'])
+    elif t == 'Submitting':
+        # whoever was submitting it is gone, so we do not know
+        return Unknown()
     else:
         assert t == 'Unknown'
         return Unknown()
@@ -232,6 +235,35 @@ class Building(object):
         return not self == other
 
 
+class Submitting(object):
+    # we are looking for the image and creating the job on another thread,
+    # PRS hears about the result in a BuildSubmitted event
+    def __init__(self, target_sha):
+        self.target_sha = target_sha
+
+    def transition(self, other):
+        return other
+
+    def __str__(self):
+        return f'build being submitted. target: {self.target_sha[0:12]}'
+
+    def to_json(self):
+        return {
+            'type': 'Submitting',
+            'target_sha': self.target_sha
+        }
+
+    def gh_state(self):
+        return 'pending'
+
+    def __eq__(self, other):
+        return (isinstance(other, Submitting) and
+                self.target_sha == other.target_sha)
+
+    def __ne__(self, other):
+        return not self == other
+
+
 class Buildable(object):
     def __init__(self, image, target_sha):
         self.image = image
@@ -242,7 +274,8 @@ class Buildable(object):
 
     def transition(self, other):
         if (not isinstance(other, Building) and
-            not isinstance(other, Buildable)):
+            not isinstance(other, Buildable) and
+            not isinstance(other, Submitting)):
             log.warning(f'unusual transition {self} to {other}')
         return other
 
@@ -274,6 +307,7 @@ class NoImage(object):
     def transition(self, other):
         if (not isinstance(other, Buildable) and
             not isinstance(other, Building) and
+            not isinstance(other, Submitting) and
             not (isinstance(other, NoImage) and self != other)):
             raise ValueError(f'bad transition {self} to {other}')
         return other
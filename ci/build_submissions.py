@@ -0,0 +1,62 @@
+from ci_logging import log
+from environment import BUILD_SUBMISSION_PARALLELISM
+import concurrent.futures
+import threading
+
+
+class BuildSubmissions(object):
+    # Finding a build image and creating a batch job both take seconds, so
+    # they happen on a pool of threads. f(source, target) returns the PR's
+    # new build state, and when it finishes on_done is called with source,
+    # target, and that state. Submitting the same f for the same pair again
+    # while it is running does nothing.
+    def __init__(self, parallelism):
+        self.parallelism = parallelism
+        self.on_done = None
+        self.submitted = 0
+        self.duplicates = 0
+        self.completed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=parallelism)
+
+    def submit(self, source, target, f):
+        key = (source, target, f)
+        with self._lock:
+            if key in self._in_flight:
+                self.duplicates += 1
+                return
+            self._in_flight.add(key)
+            self.submitted += 1
+        self._pool.submit(self._run, source, target, f)
+
+    def _run(self, source, target, f):
+        try:
+            build = f(source, target)
+            with self._lock:
+                self.completed += 1
+        except Exception as e:
+            log.exception(f'could not submit build of {source.short_str()} '
+                          f'into {target.short_str()} due to {e}')
+            with self._lock:
+                self.failed += 1
+            build = None
+        finally:
+            with self._lock:
+                self._in_flight.discard((source, target, f))
+        self.on_done(source, target, build)
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'parallelism': self.parallelism,
+                'in_flight': len(self._in_flight),
+                'submitted': self.submitted,
+                'duplicates': self.duplicates,
+                'completed': self.completed,
+                'failed': self.failed
+            }
+
+
+build_submissions = BuildSubmissions(BUILD_SUBMISSION_PARALLELISM)
@@ -1,30 +1,85 @@
+from async_http_helper import BadStatus, http_stats
 from batch.client import Job
-from batch_helper import try_to_cancel_job, job_ordering
+from batch_helper import \
+    job_cancellations, \
+    try_to_cancel_jobs, \
+    job_ordering, \
+    list_jobs_by_type, \
+    ReconciledJobs
 from build_state import build_state_from_gh_json
 from ci_logging import log
 from constants import BUILD_JOB_TYPE, GCS_BUCKET, DEPLOY_JOB_TYPE
 from environment import \
     batch_client, \
     WATCHED_TARGETS, \
-    REFRESH_INTERVAL_IN_SECONDS
+    GITHUB_REFRESH_MODE, \
+    GITHUB_FULL_REFRESH_EVERY, \
+    GITHUB_REFRESH_PARALLELISM, \
+    GITHUB_POOL_SIZE, \
+    GITHUB_REFRESH_INTERVAL_IN_SECONDS, \
+    GITHUB_REFRESH_MIN_INTERVAL_IN_SECONDS, \
+    GITHUB_REFRESH_MAX_INTERVAL_IN_SECONDS, \
+    BATCH_REFRESH_INTERVAL_IN_SECONDS, \
+    BATCH_FULL_REFRESH_EVERY, \
+    HEAL_INTERVAL_IN_SECONDS, \
+    REFRESH_JITTER_IN_SECONDS, \
+    WEBHOOK_COALESCE_WINDOW_IN_SECONDS, \
+    WEBHOOK_DELIVERY_CACHE_SIZE
+from events import \
+    EventLoop, \
+    Event, \
+    Push, \
+    PullRequestPush, \
+    PullRequestClosed, \
+    Review, \
+    CIBuildFinished, \
+    DeployBuildFinished, \
+    ForceRetest, \
+    ForceRedeploy, \
+    UpdateWatchState, \
+    Heal, \
+    BuildSubmitted
+from build_submissions import build_submissions
 from flask import Flask, request, jsonify
+from git_mirror import git_mirrors
 from git_state import Repo, FQRef, FQSHA
-from github import open_pulls, overall_review_state, latest_sha_for_ref
+from github import \
+    branch_heads, \
+    iter_open_pulls, \
+    iter_pulls_updated_since, \
+    open_pulls_snapshot, \
+    overall_review_state, \
+    latest_sha_for_ref, \
+    review_fingerprints
 from google_storage import \
     upload_public_gs_file_from_filename, \
     upload_public_gs_file_from_string
-from http_helper import BadStatus
+from image_cache import image_cache
 from http_helper import get_repo
 from pr import review_status, GitHubPR
 from prs import PRS
+from rate_limit import REFRESH
+from refresh_scheduler import RefreshScheduler
+from status_queue import github_statuses
+from webhooks import Webhooks
+import async_http_helper
 import collections
+import concurrent.futures
 import json
 import logging
-import requests
-import threading
 import time
 
 prs = PRS({k: v for [k, v] in WATCHED_TARGETS})
+# only the event loop's thread touches prs, everyone else submits events
+event_loop = EventLoop(prs)
+# builds are submitted off the event loop's thread and report back to it
+build_submissions.on_done = lambda source, target, build: \
+    event_loop.submit(BuildSubmitted(source, target, build))
+webhooks = Webhooks(event_loop,
+                    WEBHOOK_COALESCE_WINDOW_IN_SECONDS,
+                    WEBHOOK_DELIVERY_CACHE_SIZE)
+github_refresh_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=GITHUB_REFRESH_PARALLELISM)
 
 app = Flask(__name__)
 
@@ -37,17 +92,55 @@ def handle_invalid_usage(error):
 
 @app.route('/status')
 def status():
-    return jsonify(prs.to_json())
+    return jsonify(event_loop.status)
+
+
+@app.route('/stats')
+def stats():
+    return jsonify({
+        'http': http_stats(),
+        'statuses': github_statuses.to_json(),
+        'branch_heads': branch_heads.to_json(),
+        'reviews': review_fingerprints.to_json(),
+        'batch_jobs': reconciled_jobs.to_json(),
+        'cancellations': job_cancellations.to_json(),
+        'phases': refresh_scheduler.to_json(),
+        'events': event_loop.to_json(),
+        'heal': prs.heal_stats(),
+        'git_mirrors': git_mirrors.to_json(),
+        'images': image_cache.to_json(),
+        'build_submissions': build_submissions.to_json(),
+        'webhooks': webhooks.to_json(),
+        'refresh_watermarks': {
+            repo.short_str(): watermark
+            for repo, watermark in dict(refresh_watermarks).items()
+        },
+        'last_webhook': {
+            repo.short_str(): when
+            for repo, when in dict(last_webhook).items()
+        },
+        'drift': {
+            repo.short_str(): count
+            for repo, count in dict(drift).items()
+        }
+    })
 
 
 @app.route('/push', methods=['POST'])
 def github_push():
+    if webhooks.is_duplicate(request.headers.get('X-GitHub-Delivery')):
+        return '', 200
     d = request.json
     ref = d['ref']
     if ref.startswith('refs/heads'):
         target_ref = FQRef(Repo.from_gh_json(d['repository']), ref[11:])
+        saw_webhook(target_ref.repo)
+        if d.get('deleted', False):
+            branch_heads.forget(target_ref)
+        else:
+            branch_heads.record(target_ref, d['after'])
         target = FQSHA(target_ref, d['after'])
-        prs.push(target)
+        webhooks.submit(('push', target_ref), Push(target))
     else:
         log.info(
             f'ignoring ref push {ref} because it does not start with '
@@ -58,18 +151,22 @@ def github_push():
 
 @app.route('/pull_request', methods=['POST'])
 def github_pull_request():
+    if webhooks.is_duplicate(request.headers.get('X-GitHub-Delivery')):
+        return '', 200
     d = request.json
     assert 'action' in d, d
     assert 'pull_request' in d, d
     action = d['action']
+    saw_webhook(FQSHA.from_gh_json(d['pull_request']['base']).ref.repo)
     if action in ('opened', 'synchronize'):
         target_sha = FQSHA.from_gh_json(d['pull_request']['base']).sha
         gh_pr = GitHubPR.from_gh_json(d['pull_request'], target_sha)
-        prs.pr_push(gh_pr)
+        webhooks.submit(('pull_request', gh_pr.source.ref, gh_pr.target_ref),
+                        PullRequestPush(gh_pr))
     elif action == 'closed':
         gh_pr = GitHubPR.from_gh_json(d['pull_request'])
-        log.info(f'forgetting closed pr {gh_pr.short_str()}')
-        prs.forget(gh_pr.source.ref, gh_pr.target_ref)
+        webhooks.submit(('pull_request', gh_pr.source.ref, gh_pr.target_ref),
+                        PullRequestClosed(gh_pr))
     else:
         log.info(f'ignoring pull_request with action {action}')
     return '', 200
@@ -77,26 +174,27 @@ def github_pull_request():
 
 @app.route('/pull_request_review', methods=['POST'])
 def github_pull_request_review():
+    if webhooks.is_duplicate(request.headers.get('X-GitHub-Delivery')):
+        return '', 200
     d = request.json
     action = d['action']
     gh_pr = GitHubPR.from_gh_json(d['pull_request'])
+    saw_webhook(gh_pr.target_ref.repo)
+    # a push held back by webhooks must not be applied after, and so reset,
+    # a review that came later
+    key = ('pull_request', gh_pr.source.ref, gh_pr.target_ref)
     if action == 'submitted':
         state = d['review']['state'].lower()
-        if state == 'changes_requested':
-            prs.review(gh_pr, state)
-        else:
+        if state != 'changes_requested':
             # FIXME: track all reviewers, then we don't need to talk to github
-            prs.review(
-                gh_pr,
-                review_status(
-                    get_reviews(gh_pr.target_ref.repo,
-                                gh_pr.number)))
+            state = review_status(get_reviews(gh_pr.target_ref.repo,
+                                              gh_pr.number))
+        webhooks.submit_now(key, Review(gh_pr, state))
     elif action == 'dismissed':
         # FIXME: track all reviewers, then we don't need to talk to github
-        prs.review(
-            gh_pr,
-            review_status(get_reviews(gh_pr.target_ref.repo,
-                                      gh_pr.number)))
+        state = review_status(get_reviews(gh_pr.target_ref.repo,
+                                          gh_pr.number))
+        webhooks.submit_now(key, Review(gh_pr, state))
     else:
         log.info(f'ignoring pull_request_review with action {action}')
     return '', 200
@@ -125,20 +223,42 @@ def deploy_build_done():
 
 @app.route('/refresh_batch_state', methods=['POST'])
 def refresh_batch_state():
-    jobs = batch_client.list_jobs()
-    build_jobs = [
-        job for job in jobs
-        if job.attributes and job.attributes.get('type', None) == BUILD_JOB_TYPE
-    ]
-    refresh_ci_build_jobs(build_jobs)
-    deploy_jobs = [
-        job for job in jobs
-        if job.attributes and job.attributes.get('type', None) == DEPLOY_JOB_TYPE
-    ]
-    refresh_deploy_jobs(deploy_jobs)
+    refresh_scheduler.run_now('batch')
     return '', 200
 
 
+reconciled_jobs = ReconciledJobs()
+batch_refreshes = 0
+
+
+def refresh_batch_state_phase():
+    global batch_refreshes
+    jobs_by_type = list_jobs_by_type(batch_client, [BUILD_JOB_TYPE, DEPLOY_JOB_TYPE])
+    all_jobs = jobs_by_type[BUILD_JOB_TYPE] + jobs_by_type[DEPLOY_JOB_TYPE]
+    reconciled_jobs.retain(all_jobs)
+    if batch_refreshes % BATCH_FULL_REFRESH_EVERY == 0:
+        # every so often look at everything again, in case we forgot about a
+        # PR whose finished job we already skipped
+        reconciled_jobs.clear()
+    batch_refreshes += 1
+    build_jobs = reconciled_jobs.new_jobs(jobs_by_type[BUILD_JOB_TYPE])
+    deploy_jobs = reconciled_jobs.new_jobs(jobs_by_type[DEPLOY_JOB_TYPE])
+    reconciled = event_loop.submit(BatchJobs(build_jobs, deploy_jobs)).wait()
+    reconciled_jobs.record(reconciled)
+
+
+class BatchJobs(Event):
+    def __init__(self, build_jobs, deploy_jobs):
+        Event.__init__(self)
+        self.build_jobs = build_jobs
+        self.deploy_jobs = deploy_jobs
+
+    def apply(self, prs):
+        return (refresh_ci_build_jobs(self.build_jobs) +
+                refresh_deploy_jobs(self.deploy_jobs))
+
+
+# returns the jobs that belong to a known PR
 def refresh_ci_build_jobs(jobs):
     jobs = [
         (FQSHA.from_json(json.loads(job.attributes['source'])),
@@ -148,6 +268,7 @@ def refresh_ci_build_jobs(jobs):
     ]
     jobs = [(s, t, j) for (s, t, j) in jobs if prs.exists(s, t)]
     latest_jobs = {}
+    superseded = []
     for (source, target, job) in jobs:
         key = (source, target)
         job2 = latest_jobs.get(key, None)
@@ -158,16 +279,19 @@ def refresh_ci_build_jobs(jobs):
                 log.info(
                     f'cancelling {job2.id}, preferring {job.id}'
                 )
-                try_to_cancel_job(job2)
+                superseded.append(job2)
                 latest_jobs[key] = job
             else:
                 log.info(
                     f'cancelling {job.id}, preferring {job2.id}'
                 )
-                try_to_cancel_job(job)
+                superseded.append(job)
+    try_to_cancel_jobs(superseded)
     for ((source, target), job) in latest_jobs.items():
         prs.refresh_from_ci_job(source, target, job)
+    return [job for (_, _, job) in jobs]
 
+# returns the jobs that belong to a known deploy
 def refresh_deploy_jobs(jobs):
     jobs = [
         (FQSHA.from_json(json.loads(job.attributes['target'])),
@@ -181,6 +305,7 @@ def refresh_deploy_jobs(jobs):
         if target in prs.deploy_jobs
     ]
     latest_jobs = {}
+    superseded = []
     for (target, job) in jobs:
         job2 = latest_jobs.get(target, None)
         if job2 is None:
@@ -190,22 +315,24 @@ def refresh_deploy_jobs(jobs):
                 log.info(
                     f'cancelling {job2.id}, preferring {job.id}'
                 )
-                try_to_cancel_job(job2)
+                superseded.append(job2)
                 latest_jobs[target] = job
             else:
                 log.info(
                     f'cancelling {job.id}, preferring {job2.id}'
                 )
-                try_to_cancel_job(job)
+                superseded.append(job)
+    try_to_cancel_jobs(superseded)
     for (target, job) in latest_jobs.items():
         prs.refresh_from_deploy_job(target, job)
+    return [job for (_, job) in jobs]
 
 @app.route('/force_retest', methods=['POST'])
 def force_retest():
     d = request.json
     source = FQRef.from_json(d['source'])
     target = FQRef.from_json(d['target'])
-    prs.build(source, target)
+    event_loop.submit(ForceRetest(source, target))
     return '', 200
 
 
@@ -213,35 +340,204 @@ def force_retest():
 def force_redeploy():
     d = request.json
     target = FQRef.from_json(d)
-    if target in prs.watched_target_refs():
-        prs.try_deploy(target)
+    if event_loop.submit(ForceRedeploy(target)).wait():
         return '', 200
     else:
-        return f'{target.short_str()} not in {[ref.short_str() for ref in prs.watched_target_refs()]}', 400
+        return f'{target.short_str()} not in {[ref.short_str() for ref in event_loop.watched_target_refs]}', 400
 
 
 @app.route('/refresh_github_state', methods=['POST'])
 def refresh_github_state():
-    for target_repo in prs.watched_repos():
+    refresh_scheduler.run_now('github')
+    return '', 200
+
+
+# when we last heard from GitHub about each repo, and how many refreshes of
+# it found something those webhooks should have told us
+last_webhook = {}
+drift = collections.Counter()
+# the first refresh of a repo learns everything, which is not drift
+refreshed_repos = set()
+
+
+def saw_webhook(repo):
+    last_webhook[repo] = time.time()
+
+
+def refresh_github_state_phase():
+    started = time.time()
+    watched_repos = event_loop.watched_repos()
+    # fetch every repo at once, but reconcile one repo at a time
+    futures = {
+        github_refresh_pool.submit(fetch_repo, target_repo): target_repo
+        for target_repo in watched_repos
+    }
+    drifted = 0
+    failed = 0
+    for future in concurrent.futures.as_completed(futures):
+        target_repo = futures[future]
         try:
-            pulls = open_pulls(target_repo)
-            pulls_by_target = collections.defaultdict(list)
-            latest_target_shas = {}
-            for pull in pulls:
-                gh_pr = GitHubPR.from_gh_json(pull)
-                if gh_pr.target_ref not in latest_target_shas:
-                    latest_target_shas[gh_pr.target_ref] = latest_sha_for_ref(gh_pr.target_ref)
-                sha = latest_target_shas[gh_pr.target_ref]
-                gh_pr.target_sha = sha
-                pulls_by_target[gh_pr.target_ref].append(gh_pr)
-            refresh_pulls(target_repo, pulls_by_target)
-            refresh_reviews(pulls_by_target)
-            # FIXME: I can't fit build state json in the status description
-            # refresh_statuses(pulls_by_target)
+            snapshot = future.result()
+            changed = event_loop.submit(snapshot).wait()
+            if snapshot.watermark is not None:
+                refresh_watermarks[target_repo] = max(
+                    refresh_watermarks.get(target_repo, ''), snapshot.watermark)
+            # a webhook that arrived while we were fetching may be the reason
+            # things changed, so only blame webhooks when they were quiet
+            if (changed and target_repo in refreshed_repos and
+                    last_webhook.get(target_repo, 0) < started):
+                log.info(f'refresh of {target_repo.short_str()} found changes '
+                         f'that webhooks missed')
+                drift[target_repo] += 1
+                drifted += 1
+            refreshed_repos.add(target_repo)
         except Exception as e:
             log.exception(
                 f'could not refresh state for {target_repo.short_str()} due to {e}')
-    return '', 200
+            failed += 1
+    if drifted == 0 and failed > 0:
+        return None
+    return drifted
+
+
+class RepoSnapshot(Event):
+    # everything a refresh learned about one repo from GitHub. A full snapshot
+    # has every open pull, so anything not in it is dead; otherwise it only
+    # has the pulls that changed, open or closed
+    def __init__(self,
+                 target_repo,
+                 full,
+                 pulls_by_target,
+                 review_states,
+                 closed=None,
+                 watermark=None):
+        Event.__init__(self)
+        self.target_repo = target_repo
+        self.full = full
+        self.pulls_by_target = pulls_by_target
+        self.review_states = review_states
+        self.closed = [] if closed is None else closed
+        self.watermark = watermark
+
+    # returns True if this changed anything webhooks should have told us
+    def apply(self, prs):
+        before = prs.github_fingerprint(self.target_repo)
+        if self.full:
+            refresh_pulls(self.target_repo, self.pulls_by_target)
+        else:
+            for gh_pr in self.closed:
+                prs.forget(gh_pr.source.ref, gh_pr.target_ref)
+            for pulls in self.pulls_by_target.values():
+                for gh_pr in pulls:
+                    prs.pr_push(gh_pr)
+        for pulls in self.pulls_by_target.values():
+            for gh_pr in pulls:
+                # missing if we could not fetch its reviews this time
+                if gh_pr.number in self.review_states:
+                    prs.review(gh_pr, self.review_states[gh_pr.number])
+        # FIXME: I can't fit build state json in the status description
+        # refresh_statuses(self.pulls_by_target)
+        return before != prs.github_fingerprint(self.target_repo)
+
+    def __str__(self):
+        return f'[RepoSnapshot {self.target_repo.short_str()}]'
+
+
+# the newest updated_at we have reconciled for each repo
+refresh_watermarks = {}
+incremental_refreshes = collections.Counter()
+
+
+def fetch_repo(target_repo):
+    snapshot = fetch_repo_snapshot(target_repo)
+    if snapshot.full:
+        git_mirrors.prune_remotes(
+            target_repo,
+            {gh_pr.source.ref.repo
+             for pulls in snapshot.pulls_by_target.values()
+             for gh_pr in pulls})
+    return snapshot
+
+
+def fetch_repo_snapshot(target_repo):
+    if GITHUB_REFRESH_MODE == 'graphql':
+        return fetch_repo_from_graphql(target_repo)
+    if GITHUB_REFRESH_MODE == 'incremental':
+        watermark = refresh_watermarks.get(target_repo, None)
+        if (watermark is not None and
+                incremental_refreshes[target_repo] < GITHUB_FULL_REFRESH_EVERY - 1):
+            incremental_refreshes[target_repo] += 1
+            return fetch_changed_pulls(target_repo, watermark)
+        # only a full sweep notices a dead target branch or a closure we
+        # somehow missed
+        incremental_refreshes[target_repo] = 0
+    return fetch_repo_from_rest(target_repo)
+
+
+def fetch_repo_from_rest(target_repo):
+    pulls_by_target = collections.defaultdict(list)
+    latest_target_shas = {}
+    watermark = None
+    for pull in iter_open_pulls(target_repo, priority=REFRESH):
+        watermark = max(watermark or '', pull['updated_at'])
+        gh_pr = GitHubPR.from_gh_json(pull)
+        if gh_pr.target_ref not in latest_target_shas:
+            latest_target_shas[gh_pr.target_ref] = latest_sha_for_ref(
+                gh_pr.target_ref, priority=REFRESH, fresh=True)
+        sha = latest_target_shas[gh_pr.target_ref]
+        gh_pr.target_sha = sha
+        pulls_by_target[gh_pr.target_ref].append(gh_pr)
+    review_fingerprints.retain(
+        target_repo,
+        {gh_pr.number for pulls in pulls_by_target.values() for gh_pr in pulls})
+    return RepoSnapshot(target_repo,
+                        True,
+                        pulls_by_target,
+                        fetch_review_states(pulls_by_target),
+                        watermark=watermark)
+
+
+def fetch_changed_pulls(target_repo, watermark):
+    pulls_by_target = collections.defaultdict(list)
+    closed = []
+    latest_target_shas = {}
+    new_watermark = watermark
+    for pull in iter_pulls_updated_since(target_repo, watermark, priority=REFRESH):
+        new_watermark = max(new_watermark, pull['updated_at'])
+        if pull['head']['repo'] is None:
+            log.info(f'ignoring pull {pull["number"]} of {target_repo.short_str()} '
+                     f'whose head repository was deleted')
+            continue
+        gh_pr = GitHubPR.from_gh_json(pull)
+        if gh_pr.state == 'closed':
+            review_fingerprints.forget(gh_pr)
+            closed.append(gh_pr)
+            continue
+        if gh_pr.target_ref not in latest_target_shas:
+            latest_target_shas[gh_pr.target_ref] = latest_sha_for_ref(
+                gh_pr.target_ref, priority=REFRESH, fresh=True)
+        gh_pr.target_sha = latest_target_shas[gh_pr.target_ref]
+        pulls_by_target[gh_pr.target_ref].append(gh_pr)
+    log.info(f'{sum(len(x) for x in pulls_by_target.values())} open and '
+             f'{len(closed)} closed pulls of {target_repo.short_str()} changed '
+             f'since {watermark}')
+    return RepoSnapshot(target_repo,
+                        False,
+                        pulls_by_target,
+                        fetch_review_states(pulls_by_target),
+                        closed=closed,
+                        watermark=new_watermark)
+
+
+def fetch_repo_from_graphql(target_repo):
+    pulls_by_target = collections.defaultdict(list)
+    review_states = {}
+    for (pull, target_sha, reviews) in open_pulls_snapshot(target_repo, priority=REFRESH):
+        gh_pr = GitHubPR.from_gh_json(pull, target_sha)
+        branch_heads.record(gh_pr.target_ref, target_sha)
+        pulls_by_target[gh_pr.target_ref].append(gh_pr)
+        review_states[gh_pr.number] = overall_review_state(reviews)['state']
+    return RepoSnapshot(target_repo, True, pulls_by_target, review_states)
 
 
 def refresh_pulls(target_repo, pulls_by_target):
@@ -263,15 +559,33 @@ def refresh_pulls(target_repo, pulls_by_target):
     return pulls_by_target
 
 
-def refresh_reviews(pulls_by_target):
-    for (_, pulls) in pulls_by_target.items():
+def fetch_review_states(pulls_by_target):
+    review_states = {}
+    stale = []
+    for pulls in pulls_by_target.values():
         for gh_pr in pulls:
-            reviews = get_repo(
-                gh_pr.target_ref.repo.qname,
-                'pulls/' + gh_pr.number + '/reviews',
-                status_code=200)
-            state = overall_review_state(reviews)['state']
-            prs.review(gh_pr, state)
+            state = review_fingerprints.get(gh_pr)
+            if state is None:
+                stale.append(gh_pr)
+            else:
+                review_states[gh_pr.number] = state
+    all_reviews = async_http_helper.run_all([
+        async_http_helper.get_repo(
+            gh_pr.target_ref.repo.qname,
+            'pulls/' + gh_pr.number + '/reviews?per_page=100',
+            status_code=200,
+            priority=REFRESH)
+        for gh_pr in stale
+    ], return_exceptions=True, parallelism=GITHUB_POOL_SIZE)
+    for gh_pr, reviews in zip(stale, all_reviews):
+        if isinstance(reviews, BaseException):
+            # left stale, so the next refresh tries again
+            log.warning(f'could not fetch reviews of {gh_pr.short_str()} due to {reviews}')
+            continue
+        state = overall_review_state(reviews)['state']
+        review_fingerprints.record(gh_pr, state)
+        review_states[gh_pr.number] = state
+    return review_states
 
 
 def refresh_statuses(pulls_by_target):
@@ -280,7 +594,8 @@ def refresh_statuses(pulls_by_target):
             statuses = get_repo(
                 gh_pr.target_ref.repo.qname,
                 'commits/' + gh_pr.source.sha + '/statuses',
-                status_code=200)
+                status_code=200,
+                priority=REFRESH)
             prs.refresh_from_github_build_status(
                 gh_pr,
                 build_state_from_gh_json(statuses))
@@ -288,10 +603,14 @@ def refresh_statuses(pulls_by_target):
 
 @app.route('/heal', methods=['POST'])
 def heal():
-    prs.heal()
+    refresh_scheduler.run_now('heal')
     return '', 200
 
 
+def heal_phase():
+    event_loop.submit(Heal()).wait()
+
+
 @app.route('/healthcheck')
 def healthcheck():
     return '', 200
@@ -303,7 +622,7 @@ def set_deployable():
     target_ref = FQRef.from_json(d['target_ref'])
     action = d['action']
     assert action in ('unwatch', 'watch', 'deploy')
-    prs.update_watch_state(target_ref, action)
+    event_loop.submit(UpdateWatchState(target_ref, action))
     return '', 200
 
 
@@ -318,7 +637,7 @@ def receive_ci_job(source, target, job):
         GCS_BUCKET,
         f'ci/{source.sha}/{target.sha}/index.html',
         'index.html')
-    prs.ci_build_finished(source, target, job)
+    event_loop.submit(CIBuildFinished(source, target, job))
 
 
 def receive_deploy_job(target, job):
@@ -329,33 +648,31 @@ def receive_deploy_job(target, job):
         GCS_BUCKET,
         f'deploy/{target.sha}/index.html',
         'deploy-index.html')
-    prs.deploy_build_finished(target, job)
+    event_loop.submit(DeployBuildFinished(target, job))
 
 
 def get_reviews(repo, pr_number):
     return get_repo(
         repo.qname,
-        'pulls/' + pr_number + '/reviews',
+        'pulls/' + pr_number + '/reviews?per_page=100',
         status_code=200)
 
 
-def polling_event_loop():
-    time.sleep(1)
-    while True:
-        try:
-            r = requests.post(
-                'http://127.0.0.1:5000/refresh_github_state',
-                timeout=360)
-            r.raise_for_status()
-            r = requests.post(
-                'http://127.0.0.1:5000/refresh_batch_state',
-                timeout=360)
-            r.raise_for_status()
-            r = requests.post('http://127.0.0.1:5000/heal', timeout=360)
-            r.raise_for_status()
-        except Exception as e:
-            log.error(f'Could not poll due to exception: {e}')
-        time.sleep(REFRESH_INTERVAL_IN_SECONDS)
+refresh_scheduler = RefreshScheduler()
+refresh_scheduler.add('github',
+                      refresh_github_state_phase,
+                      GITHUB_REFRESH_INTERVAL_IN_SECONDS,
+                      REFRESH_JITTER_IN_SECONDS,
+                      GITHUB_REFRESH_MIN_INTERVAL_IN_SECONDS,
+                      GITHUB_REFRESH_MAX_INTERVAL_IN_SECONDS)
+refresh_scheduler.add('batch',
+                      refresh_batch_state_phase,
+                      BATCH_REFRESH_INTERVAL_IN_SECONDS,
+                      REFRESH_JITTER_IN_SECONDS)
+refresh_scheduler.add('heal',
+                      heal_phase,
+                      HEAL_INTERVAL_IN_SECONDS,
+                      REFRESH_JITTER_IN_SECONDS)
 
 
 def fix_werkzeug_logs():
@@ -368,5 +685,5 @@ def fix_werkzeug_logs():
 
 if __name__ == '__main__':
     fix_werkzeug_logs()
-    threading.Thread(target=polling_event_loop).start()
-    app.run(host='0.0.0.0', threaded=False)
+    refresh_scheduler.start()
+    app.run(host='0.0.0.0', threaded=True)
@@ -10,6 +10,52 @@ BATCH_SERVER_URL = os.environ.get('BATCH_SERVER_URL',
                                   'http://set_the_BATCH_SERVER_URL/')
 REFRESH_INTERVAL_IN_SECONDS = \
     int(os.environ.get('REFRESH_INTERVAL_IN_SECONDS', 60))
+GITHUB_REFRESH_INTERVAL_IN_SECONDS = int(os.environ.get(
+    'GITHUB_REFRESH_INTERVAL_IN_SECONDS', REFRESH_INTERVAL_IN_SECONDS))
+GITHUB_REFRESH_MIN_INTERVAL_IN_SECONDS = int(os.environ.get(
+    'GITHUB_REFRESH_MIN_INTERVAL_IN_SECONDS', GITHUB_REFRESH_INTERVAL_IN_SECONDS // 4))
+GITHUB_REFRESH_MAX_INTERVAL_IN_SECONDS = int(os.environ.get(
+    'GITHUB_REFRESH_MAX_INTERVAL_IN_SECONDS', GITHUB_REFRESH_INTERVAL_IN_SECONDS * 10))
+if not (GITHUB_REFRESH_MIN_INTERVAL_IN_SECONDS <=
+        GITHUB_REFRESH_INTERVAL_IN_SECONDS <=
+        GITHUB_REFRESH_MAX_INTERVAL_IN_SECONDS):
+    raise ValueError(
+        f'GITHUB_REFRESH_INTERVAL_IN_SECONDS ({GITHUB_REFRESH_INTERVAL_IN_SECONDS}) '
+        f'must be between GITHUB_REFRESH_MIN_INTERVAL_IN_SECONDS '
+        f'({GITHUB_REFRESH_MIN_INTERVAL_IN_SECONDS}) and '
+        f'GITHUB_REFRESH_MAX_INTERVAL_IN_SECONDS '
+        f'({GITHUB_REFRESH_MAX_INTERVAL_IN_SECONDS})')
+BATCH_REFRESH_INTERVAL_IN_SECONDS = int(os.environ.get(
+    'BATCH_REFRESH_INTERVAL_IN_SECONDS', REFRESH_INTERVAL_IN_SECONDS))
+BATCH_FULL_REFRESH_EVERY = int(os.environ.get('BATCH_FULL_REFRESH_EVERY', 10))
+BATCH_CANCEL_PARALLELISM = int(os.environ.get('BATCH_CANCEL_PARALLELISM', 8))
+GIT_MIRROR_DIR = os.environ.get('GIT_MIRROR_DIR', 'git-mirrors')
+IMAGE_CACHE_SIZE = int(os.environ.get('IMAGE_CACHE_SIZE', 10000))
+IMAGE_CACHE_FILE = os.environ.get('IMAGE_CACHE_FILE', None)
+BUILD_SUBMISSION_PARALLELISM = int(os.environ.get('BUILD_SUBMISSION_PARALLELISM', 4))
+HEAL_INTERVAL_IN_SECONDS = int(os.environ.get(
+    'HEAL_INTERVAL_IN_SECONDS', 5 * REFRESH_INTERVAL_IN_SECONDS))
+REFRESH_JITTER_IN_SECONDS = int(os.environ.get('REFRESH_JITTER_IN_SECONDS', 5))
+GITHUB_REFRESH_MODE = os.environ.get('GITHUB_REFRESH_MODE', 'rest')
+if GITHUB_REFRESH_MODE not in ('rest', 'incremental', 'graphql'):
+    raise ValueError(
+        'environment variable GITHUB_REFRESH_MODE should be one of `rest\', '
+        f'`incremental\', or `graphql\', but was: `{GITHUB_REFRESH_MODE}\'')
+# in incremental mode, every this many refreshes of a repo is a full refresh
+GITHUB_FULL_REFRESH_EVERY = int(os.environ.get('GITHUB_FULL_REFRESH_EVERY', 10))
+GITHUB_REFRESH_PARALLELISM = int(os.environ.get('GITHUB_REFRESH_PARALLELISM', 4))
+GITHUB_POOL_SIZE = int(os.environ.get('GITHUB_POOL_SIZE', 10))
+GITHUB_KEEP_ALIVE = os.environ.get('GITHUB_KEEP_ALIVE', 'true') == 'true'
+GITHUB_CACHE_SIZE = int(os.environ.get('GITHUB_CACHE_SIZE', 1000))
+GITHUB_PAGE_PARALLELISM = int(os.environ.get('GITHUB_PAGE_PARALLELISM', 4))
+GITHUB_RATE_LIMIT_MAX_WAIT_IN_SECONDS = \
+    int(os.environ.get('GITHUB_RATE_LIMIT_MAX_WAIT_IN_SECONDS', 30))
+GITHUB_STATUS_PARALLELISM = int(os.environ.get('GITHUB_STATUS_PARALLELISM', 4))
+WEBHOOK_COALESCE_WINDOW_IN_SECONDS = \
+    float(os.environ.get('WEBHOOK_COALESCE_WINDOW_IN_SECONDS', 2))
+WEBHOOK_DELIVERY_CACHE_SIZE = int(os.environ.get('WEBHOOK_DELIVERY_CACHE_SIZE', 1000))
+BRANCH_HEAD_MAX_AGE_IN_SECONDS = \
+    int(os.environ.get('BRANCH_HEAD_MAX_AGE_IN_SECONDS', 2 * REFRESH_INTERVAL_IN_SECONDS))
 
 try:
     WATCHED_TARGETS = [
@@ -42,10 +88,45 @@ except FileNotFoundError as e:
     raise ValueError(
         "working directory must contain `oauth-token/oauth-token' "
         "containing a valid GitHub oauth token") from e
+# oauth_token is used for every write, reads are spread over it and any
+# additional tokens found in GITHUB_READ_TOKENS_DIR
+GITHUB_READ_TOKENS_DIR = os.environ.get('GITHUB_READ_TOKENS_DIR', 'oauth-tokens')
+oauth_tokens = {'oauth-token': oauth_token}
+if os.path.isdir(GITHUB_READ_TOKENS_DIR):
+    for name in sorted(os.listdir(GITHUB_READ_TOKENS_DIR)):
+        path = os.path.join(GITHUB_READ_TOKENS_DIR, name)
+        if not name.startswith('.') and os.path.isfile(path):
+            with open(path, 'r') as f:
+                oauth_tokens[name] = f.read().strip()
 
 log.info(f'BATCH_SERVER_URL {BATCH_SERVER_URL}')
 log.info(f'SELF_HOSTNAME {SELF_HOSTNAME}')
 log.info(f'REFRESH_INTERVAL_IN_SECONDS {REFRESH_INTERVAL_IN_SECONDS}')
+log.info(f'GITHUB_REFRESH_INTERVAL_IN_SECONDS {GITHUB_REFRESH_INTERVAL_IN_SECONDS}')
+log.info(f'GITHUB_REFRESH_MIN_INTERVAL_IN_SECONDS {GITHUB_REFRESH_MIN_INTERVAL_IN_SECONDS}')
+log.info(f'GITHUB_REFRESH_MAX_INTERVAL_IN_SECONDS {GITHUB_REFRESH_MAX_INTERVAL_IN_SECONDS}')
+log.info(f'BATCH_REFRESH_INTERVAL_IN_SECONDS {BATCH_REFRESH_INTERVAL_IN_SECONDS}')
+log.info(f'BATCH_FULL_REFRESH_EVERY {BATCH_FULL_REFRESH_EVERY}')
+log.info(f'BATCH_CANCEL_PARALLELISM {BATCH_CANCEL_PARALLELISM}')
+log.info(f'GIT_MIRROR_DIR {GIT_MIRROR_DIR}')
+log.info(f'IMAGE_CACHE_SIZE {IMAGE_CACHE_SIZE}')
+log.info(f'IMAGE_CACHE_FILE {IMAGE_CACHE_FILE}')
+log.info(f'BUILD_SUBMISSION_PARALLELISM {BUILD_SUBMISSION_PARALLELISM}')
+log.info(f'HEAL_INTERVAL_IN_SECONDS {HEAL_INTERVAL_IN_SECONDS}')
+log.info(f'REFRESH_JITTER_IN_SECONDS {REFRESH_JITTER_IN_SECONDS}')
+log.info(f'GITHUB_REFRESH_MODE {GITHUB_REFRESH_MODE}')
+log.info(f'GITHUB_FULL_REFRESH_EVERY {GITHUB_FULL_REFRESH_EVERY}')
+log.info(f'GITHUB_REFRESH_PARALLELISM {GITHUB_REFRESH_PARALLELISM}')
+log.info(f'GITHUB_POOL_SIZE {GITHUB_POOL_SIZE}')
+log.info(f'GITHUB_KEEP_ALIVE {GITHUB_KEEP_ALIVE}')
+log.info(f'GITHUB_CACHE_SIZE {GITHUB_CACHE_SIZE}')
+log.info(f'GITHUB_PAGE_PARALLELISM {GITHUB_PAGE_PARALLELISM}')
+log.info(f'GITHUB_RATE_LIMIT_MAX_WAIT_IN_SECONDS {GITHUB_RATE_LIMIT_MAX_WAIT_IN_SECONDS}')
+log.info(f'GITHUB_STATUS_PARALLELISM {GITHUB_STATUS_PARALLELISM}')
+log.info(f'WEBHOOK_COALESCE_WINDOW_IN_SECONDS {WEBHOOK_COALESCE_WINDOW_IN_SECONDS}')
+log.info(f'WEBHOOK_DELIVERY_CACHE_SIZE {WEBHOOK_DELIVERY_CACHE_SIZE}')
+log.info(f'BRANCH_HEAD_MAX_AGE_IN_SECONDS {BRANCH_HEAD_MAX_AGE_IN_SECONDS}')
+log.info(f'GITHUB_READ_TOKENS_DIR {GITHUB_READ_TOKENS_DIR}, using tokens {list(oauth_tokens.keys())}')
 log.info(f'WATCHED_TARGETS {[(ref.short_str(), deployable) for (ref, deployable) in WATCHED_TARGETS]}')
 
 batch_client = BatchClient(url=BATCH_SERVER_URL)
@@ -0,0 +1,238 @@
+from ci_logging import log
+from git_state import FQRef, FQSHA
+from pr import GitHubPR
+import collections
+import queue
+import threading
+import time
+
+# Everything that changes PRS is an event. Events are applied one at a time,
+# in the order they were submitted, by the thread that owns PRS, so nothing
+# else needs to lock it.
+
+
+class Event(object):
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def apply(self, prs):
+        raise NotImplementedError
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError(f'{self} was not applied within {timeout} seconds')
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def __str__(self):
+        return type(self).__name__
+
+
+class Push(Event):
+    def __init__(self, target):
+        Event.__init__(self)
+        assert isinstance(target, FQSHA), target
+        self.target = target
+
+    def apply(self, prs):
+        prs.push(self.target)
+
+    def __str__(self):
+        return f'[Push {self.target.short_str()}]'
+
+
+class PullRequestPush(Event):
+    def __init__(self, gh_pr):
+        Event.__init__(self)
+        assert isinstance(gh_pr, GitHubPR), gh_pr
+        self.gh_pr = gh_pr
+
+    def apply(self, prs):
+        prs.pr_push(self.gh_pr)
+
+    def __str__(self):
+        return f'[PullRequestPush {self.gh_pr.short_str()}]'
+
+
+class PullRequestClosed(Event):
+    def __init__(self, gh_pr):
+        Event.__init__(self)
+        assert isinstance(gh_pr, GitHubPR), gh_pr
+        self.gh_pr = gh_pr
+
+    def apply(self, prs):
+        log.info(f'forgetting closed pr {self.gh_pr.short_str()}')
+        prs.forget(self.gh_pr.source.ref, self.gh_pr.target_ref)
+
+    def __str__(self):
+        return f'[PullRequestClosed {self.gh_pr.short_str()}]'
+
+
+class Review(Event):
+    def __init__(self, gh_pr, state):
+        Event.__init__(self)
+        assert isinstance(gh_pr, GitHubPR), gh_pr
+        self.gh_pr = gh_pr
+        self.state = state
+
+    def apply(self, prs):
+        prs.review(self.gh_pr, self.state)
+
+    def __str__(self):
+        return f'[Review {self.gh_pr.short_str()} {self.state}]'
+
+
+class CIBuildFinished(Event):
+    def __init__(self, source, target, job):
+        Event.__init__(self)
+        assert isinstance(source, FQSHA), source
+        assert isinstance(target, FQSHA), target
+        self.source = source
+        self.target = target
+        self.job = job
+
+    def apply(self, prs):
+        prs.ci_build_finished(self.source, self.target, self.job)
+
+    def __str__(self):
+        return f'[CIBuildFinished {self.job.id}]'
+
+
+class DeployBuildFinished(Event):
+    def __init__(self, target, job):
+        Event.__init__(self)
+        assert isinstance(target, FQSHA), target
+        self.target = target
+        self.job = job
+
+    def apply(self, prs):
+        prs.deploy_build_finished(self.target, self.job)
+
+    def __str__(self):
+        return f'[DeployBuildFinished {self.job.id}]'
+
+
+class BuildSubmitted(Event):
+    def __init__(self, source, target, build):
+        Event.__init__(self)
+        assert isinstance(source, FQSHA), source
+        assert isinstance(target, FQSHA), target
+        self.source = source
+        self.target = target
+        self.build = build
+
+    def apply(self, prs):
+        prs.build_submitted(self.source, self.target, self.build)
+
+    def __str__(self):
+        return f'[BuildSubmitted {self.source.short_str()} {self.target.short_str()} {self.build}]'
+
+
+class ForceRetest(Event):
+    def __init__(self, source, target):
+        Event.__init__(self)
+        assert isinstance(source, FQRef), source
+        assert isinstance(target, FQRef), target
+        self.source = source
+        self.target = target
+
+    def apply(self, prs):
+        prs.build(self.source, self.target)
+
+
+class ForceRedeploy(Event):
+    def __init__(self, target):
+        Event.__init__(self)
+        assert isinstance(target, FQRef), target
+        self.target = target
+
+    # returns False if the target is not watched
+    def apply(self, prs):
+        if not prs.is_watched_target_ref(self.target):
+            return False
+        prs.try_deploy(self.target)
+        return True
+
+
+class UpdateWatchState(Event):
+    def __init__(self, target, action):
+        Event.__init__(self)
+        assert isinstance(target, FQRef), target
+        assert action in ('unwatch', 'watch', 'deploy')
+        self.target = target
+        self.action = action
+
+    def apply(self, prs):
+        prs.update_watch_state(self.target, self.action)
+
+
+class Heal(Event):
+    def apply(self, prs):
+        prs.heal()
+
+
+class HealDirty(Event):
+    def apply(self, prs):
+        prs.heal_dirty()
+
+
+class EventLoop(object):
+    def __init__(self, prs):
+        self.prs = prs
+        self.applied = collections.Counter()
+        self.failed = collections.Counter()
+        self.last_duration = None
+        self.max_duration = None
+        self._queue = queue.Queue()
+        self._publish()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, event):
+        assert isinstance(event, Event), event
+        self._queue.put(event)
+        return event
+
+    def _run(self):
+        while True:
+            self._apply(self._queue.get())
+            if self._queue.empty():
+                # heal once per burst of events rather than once per event
+                if len(self.prs.dirty_targets) != 0:
+                    self._apply(HealDirty())
+                self._publish()
+
+    def _apply(self, event):
+        start = time.time()
+        try:
+            event.result = event.apply(self.prs)
+            self.applied[type(event).__name__] += 1
+        except Exception as e:
+            log.exception(f'could not apply {event} due to {e}')
+            event.error = e
+            self.failed[type(event).__name__] += 1
+        finally:
+            event._done.set()
+        duration = time.time() - start
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration or 0.0, duration)
+
+    # readers never look at PRS itself, only at the state as of the last
+    # time the queue was empty
+    def _publish(self):
+        self.status = self.prs.to_json()
+        self.watched_target_refs = list(self.prs.watched_target_refs())
+
+    def watched_repos(self):
+        return {ref.repo for ref in self.watched_target_refs}
+
+    def to_json(self):
+        return {
+            'queue_depth': self._queue.qsize(),
+            'applied': dict(self.applied),
+            'failed': dict(self.failed),
+            'last_duration': self.last_duration,
+            'max_duration': self.max_duration
+        }
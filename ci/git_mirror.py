@@ -0,0 +1,216 @@
+from ci_logging import log
+from environment import GIT_MIRROR_DIR
+from shell_helper import shell, succeeds
+import collections
+import contextlib
+import os
+import re
+import subprocess as sp
+import tempfile
+import threading
+
+
+class GitMirrors(object):
+    # One bare mirror per target repo, with a remote for every fork we have
+    # seen a PR from. Nobody ever checks out a branch in a mirror; each
+    # merge happens in its own short-lived worktree, so many can run at once
+    # and a crash leaves at most a stale worktree behind, which the next
+    # `git worktree prune` cleans up.
+    def __init__(self, root, blobless):
+        self.root = root
+        self.blobless = blobless
+        self.fetches = 0
+        self.fetches_avoided = 0
+        self.pruned_remotes = 0
+        self._lock = threading.Lock()
+        self._repo_locks = {}
+        self._in_use = collections.Counter()
+
+    def _repo_lock(self, repo):
+        with self._lock:
+            lock = self._repo_locks.get(repo, None)
+            if lock is None:
+                lock = threading.Lock()
+                self._repo_locks[repo] = lock
+            return lock
+
+    def path(self, repo):
+        return os.path.abspath(os.path.join(self.root, f'{repo.qname}.git'))
+
+    def _ensure(self, repo):
+        path = self.path(repo)
+        if not os.path.isdir(path):
+            log.info(f'creating mirror of {repo.qname} in {path}')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shell('git', 'init', '--bare', path)
+            self._add_remote(path, 'origin', repo.url)
+        else:
+            shell('git', 'worktree', 'prune', cwd=path)
+        return path
+
+    # If blobless, mirrors are blobless partial clones of origin: fetches
+    # from it bring commits and trees only, and git fetches the few blobs a
+    # merge actually reads from it later. Git asks one promisor remote at a
+    # time for all of the blobs it is missing, so they must all be on
+    # origin. Fetches from forks therefore bring the blobs of the fork's own
+    # commits along; the fork remotes are only promisors so that their packs
+    # may refer to the blobs we left on origin.
+    def _add_remote(self, path, remote, url):
+        shell('git', 'remote', 'add', remote, url, cwd=path)
+        if self.blobless:
+            shell('git', 'config', f'remote.{remote}.promisor', 'true', cwd=path)
+            if remote == 'origin':
+                shell('git', 'config', f'remote.{remote}.partialclonefilter', 'blob:none',
+                      cwd=path)
+
+    def _remote_for(self, path, repo, remote_repo):
+        if remote_repo == repo:
+            return 'origin'
+        remote = remote_repo.qname
+        if not succeeds('git', 'remote', 'get-url', remote, cwd=path):
+            self._add_remote(path, remote, remote_repo.url)
+        return remote
+
+    def has_commits(self, path, shas):
+        if self.blobless:
+            # unlike cat-file, rev-list --missing never lazily fetches from a
+            # promisor remote
+            return all(succeeds('git', 'rev-list', '--no-walk', '--missing=print', sha,
+                                cwd=path)
+                       for sha in shas)
+        return all(succeeds('git', 'cat-file', '-e', f'{sha}^{{commit}}', cwd=path)
+                   for sha in shas)
+
+    # makes sure the mirror of repo contains each (remote_repo, sha) in
+    # wants, where remote_repo is repo or a fork of it. Only the missing
+    # commits are fetched, by sha, so the cost does not grow with the number
+    # of branches or forks.
+    def fetch(self, repo, wants):
+        with self._repo_lock(repo):
+            path = self._ensure(repo)
+            missing = [(remote_repo, sha)
+                       for (remote_repo, sha) in wants
+                       if not self.has_commits(path, [sha])]
+            if len(missing) == 0:
+                self.fetches_avoided += 1
+                return path
+            for (remote_repo, sha) in missing:
+                self.fetches += 1
+                remote = self._remote_for(path, repo, remote_repo)
+                if self.blobless and remote == 'origin':
+                    shell('git', 'fetch', '--no-tags', '--filter=blob:none', remote, sha,
+                          cwd=path)
+                else:
+                    shell('git', 'fetch', '--no-tags', remote, sha, cwd=path)
+            return path
+
+    # A blobless merge fetches the blobs it reads from promisor remotes long
+    # after fetch returns, so whoever merges holds on to the remotes it
+    # fetched from for as long as it reads from the mirror.
+    @contextlib.contextmanager
+    def using(self, repo, remote_repos):
+        remotes = [(repo, remote_repo.qname)
+                   for remote_repo in remote_repos
+                   if remote_repo != repo]
+        with self._lock:
+            self._in_use.update(remotes)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_use.subtract(remotes)
+                for remote in remotes:
+                    if self._in_use[remote] <= 0:
+                        del self._in_use[remote]
+
+    def _is_in_use(self, repo, remote):
+        with self._lock:
+            return (repo, remote) in self._in_use
+
+    # forgets the remotes of forks that no longer have open PRs and that no
+    # merge is using
+    def prune_remotes(self, repo, source_repos):
+        path = self.path(repo)
+        if not os.path.isdir(path):
+            return
+        keep = {source_repo.qname for source_repo in source_repos}
+        with self._repo_lock(repo):
+            for remote in shell('git', 'remote', cwd=path).split():
+                if (remote != 'origin' and
+                        remote not in keep and
+                        not self._is_in_use(repo, remote)):
+                    log.info(f'removing remote {remote} from mirror of {repo.qname}')
+                    shell('git', 'remote', 'remove', remote, cwd=path)
+                    self.pruned_remotes += 1
+
+    @contextlib.contextmanager
+    def worktree(self, repo, sha):
+        path = self.path(repo)
+        d = tempfile.mkdtemp(prefix='worktree-', dir=os.path.dirname(path))
+        with self._repo_lock(repo):
+            shell('git', 'worktree', 'add', '--detach', d, sha, cwd=path)
+        try:
+            yield d
+        finally:
+            with self._repo_lock(repo):
+                shell('git', 'worktree', 'remove', '--force', d, cwd=path)
+
+    # everything below reads the object database only, so it needs neither
+    # a worktree nor the repo lock
+
+    def is_ancestor(self, repo, ancestor, descendant):
+        return succeeds('git', 'merge-base', '--is-ancestor', ancestor, descendant,
+                        cwd=self.path(repo))
+
+    # the tree that merging the two commits would produce, or None if they
+    # conflict
+    def merged_tree(self, repo, sha1, sha2):
+        try:
+            return shell('git', 'merge-tree', '--write-tree', '--no-messages',
+                         sha1, sha2, cwd=self.path(repo)).splitlines()[0]
+        except sp.CalledProcessError as e:
+            if e.returncode == 1:
+                return None
+            raise
+
+    # trees are never left behind by a blobless fetch, so unlike read_file
+    # this never goes to the network
+    def has_file(self, repo, treeish, filename):
+        return shell('git', 'ls-tree', '--name-only', treeish, '--', filename,
+                     cwd=self.path(repo)).strip() != ''
+
+    def read_file(self, repo, treeish, filename):
+        return shell('git', 'cat-file', 'blob', f'{treeish}:{filename}',
+                     cwd=self.path(repo))
+
+    def to_json(self):
+        return {
+            'root': self.root,
+            'blobless': self.blobless,
+            'fetches': self.fetches,
+            'fetches_avoided': self.fetches_avoided,
+            'pruned_remotes': self.pruned_remotes
+        }
+
+
+def git_version():
+    m = re.search(r'(\d+)\.(\d+)', shell('git', 'version'))
+    if m is None:
+        return None
+    return (int(m.group(1)), int(m.group(2)))
+
+
+def git_supports_merge_tree():
+    # `git merge-tree --write-tree` appeared in git 2.38
+    version = git_version()
+    return version is not None and version >= (2, 38)
+
+
+def git_supports_blobless_mirrors():
+    # lazily fetching missing objects from more than one promisor remote
+    # appeared in git 2.24
+    version = git_version()
+    return version is not None and version >= (2, 24)
+
+
+git_mirrors = GitMirrors(GIT_MIRROR_DIR, git_supports_blobless_mirrors())
@@ -1,5 +1,9 @@
-from http_helper import get_repo
+from ci_logging import log
+from environment import BRANCH_HEAD_MAX_AGE_IN_SECONDS
+from http_helper import get_repo, iter_repo, verb_github
 import re
+import threading
+import time
 
 clone_url_to_repo = re.compile('https://github.com/([^/]+)/([^/]+).git')
 
@@ -19,16 +23,266 @@ def url_from_repo(repo):
     return f'https://github.com/{repo}.git'
 
 
-def open_pulls(target_repo):
-    return get_repo(target_repo.qname, 'pulls?state=open', status_code=200)
+branch_fields = {
+    'ref': None,
+    'sha': None,
+    'repo': {
+        'name': None,
+        'owner': {'login': None}
+    }
+}
 
+# everything GitHubPR.from_gh_json needs
+pull_fields = {
+    'state': None,
+    'number': None,
+    'title': None,
+    'updated_at': None,
+    'head': branch_fields,
+    'base': branch_fields
+}
 
-def latest_sha_for_ref(ref):
-    d = get_repo(ref.repo.qname, f'git/refs/heads/{ref.name}', status_code=200)
+
+def iter_open_pulls(target_repo, priority=None):
+    return iter_repo(target_repo.qname,
+                     'pulls?state=open&per_page=100',
+                     fields=pull_fields,
+                     priority=priority)
+
+
+# open and closed pulls updated at or after since, newest first
+def iter_pulls_updated_since(target_repo, since, priority=None):
+    pulls = iter_repo(target_repo.qname,
+                      'pulls?state=all&sort=updated&direction=desc&per_page=100',
+                      fields=pull_fields,
+                      priority=priority,
+                      prefetch=False)
+    for pull in pulls:
+        # GitHub's timestamps are ISO 8601 in UTC, so they sort as strings
+        if pull['updated_at'] < since:
+            return
+        yield pull
+
+
+class BranchHeads(object):
+    # the head of every branch we have recently learned about, either from a
+    # push webhook or from asking GitHub
+    def __init__(self, max_age_in_seconds):
+        self.max_age_in_seconds = max_age_in_seconds
+        self.hits = 0
+        self.network = 0
+        self._lock = threading.Lock()
+        self._heads = {}
+
+    def get(self, ref):
+        with self._lock:
+            (sha, when) = self._heads.get(ref, (None, None))
+            if sha is not None and time.time() - when <= self.max_age_in_seconds:
+                self.hits += 1
+                return sha
+            return None
+
+    def record(self, ref, sha, from_network=False):
+        with self._lock:
+            if from_network:
+                self.network += 1
+            self._heads[ref] = (sha, time.time())
+
+    def forget(self, ref):
+        with self._lock:
+            self._heads.pop(ref, None)
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'max_age_in_seconds': self.max_age_in_seconds,
+                'branches': len(self._heads),
+                'hits': self.hits,
+                'network': self.network
+            }
+
+
+branch_heads = BranchHeads(BRANCH_HEAD_MAX_AGE_IN_SECONDS)
+
+
+class ReviewFingerprints(object):
+    # GitHub bumps a pull's updated_at whenever a review is submitted, so as
+    # long as neither it nor the head SHA moved, the review state we fetched
+    # last time is still right
+    def __init__(self):
+        self.skipped = 0
+        self.fetched = 0
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def _key(self, gh_pr):
+        return (gh_pr.target_ref.repo, gh_pr.number)
+
+    def _fingerprint(self, gh_pr):
+        return (gh_pr.updated_at, gh_pr.source.sha)
+
+    def get(self, gh_pr):
+        if gh_pr.updated_at is None:
+            return None
+        with self._lock:
+            (fingerprint, state) = self._states.get(self._key(gh_pr), (None, None))
+            if fingerprint == self._fingerprint(gh_pr):
+                self.skipped += 1
+                return state
+            return None
+
+    def record(self, gh_pr, state):
+        with self._lock:
+            self.fetched += 1
+            self._states[self._key(gh_pr)] = (self._fingerprint(gh_pr), state)
+
+    def forget(self, gh_pr):
+        with self._lock:
+            self._states.pop(self._key(gh_pr), None)
+
+    def retain(self, repo, numbers):
+        with self._lock:
+            self._states = {
+                (r, number): v
+                for (r, number), v in self._states.items()
+                if r != repo or number in numbers
+            }
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'pulls': len(self._states),
+                'skipped': self.skipped,
+                'fetched': self.fetched
+            }
+
+
+review_fingerprints = ReviewFingerprints()
+
+
+def latest_sha_for_ref(ref, priority=None, fresh=False):
+    if not fresh:
+        sha = branch_heads.get(ref)
+        if sha is not None:
+            return sha
+    d = get_repo(ref.repo.qname,
+                 f'git/refs/heads/{ref.name}',
+                 status_code=200,
+                 priority=priority)
     assert 'object' in d, d
     assert 'sha' in d['object'], d
-    return d['object']['sha']
+    sha = d['object']['sha']
+    branch_heads.record(ref, sha, from_network=True)
+    return sha
+
+
+open_pulls_query = '''
+query ($owner: String!, $name: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, first: 100, after: $cursor) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        number
+        title
+        headRefName
+        headRefOid
+        headRepository {
+          name
+          owner {
+            login
+          }
+        }
+        baseRefName
+        baseRef {
+          target {
+            oid
+          }
+        }
+        latestOpinionatedReviews(first: 100) {
+          nodes {
+            state
+            author {
+              login
+            }
+          }
+        }
+      }
+    }
+  }
+}
+'''
+
+
+# a list of (pull, target_sha, reviews) for every open pull request of
+# target_repo; pull and reviews are shaped like the REST API's json and
+# target_sha is the current head of the pull's base branch. One GraphQL request
+# per hundred pulls replaces open_pulls, latest_sha_for_ref for each base
+# branch, and a reviews request for each pull.
+def open_pulls_snapshot(target_repo, priority=None):
+    result = []
+    cursor = None
+    while True:
+        d = verb_github(
+            'post',
+            'graphql',
+            json={
+                'query': open_pulls_query,
+                'variables': {
+                    'owner': target_repo.owner,
+                    'name': target_repo.name,
+                    'cursor': cursor
+                }
+            },
+            status_code=200,
+            priority=priority)
+        assert 'errors' not in d, d
+        pulls = d['data']['repository']['pullRequests']
+        for node in pulls['nodes']:
+            pull = gh_json_from_graphql_pull(target_repo, node)
+            if pull is None:
+                continue
+            reviews = [
+                {'user': {'login': (review['author'] or {'login': 'ghost'})['login']},
+                 'state': review['state']}
+                for review in node['latestOpinionatedReviews']['nodes']
+            ]
+            result.append((pull, node['baseRef']['target']['oid'], reviews))
+        if not pulls['pageInfo']['hasNextPage']:
+            return result
+        cursor = pulls['pageInfo']['endCursor']
+
 
+def gh_json_from_graphql_pull(target_repo, node):
+    head_repo = node['headRepository']
+    if head_repo is None or node['baseRef'] is None:
+        log.warning(
+            f'ignoring pull {node["number"]} of {target_repo.qname} because '
+            f'its head repository or base branch no longer exists')
+        return None
+    return {
+        'state': 'open',
+        'number': node['number'],
+        'title': node['title'],
+        'head': {
+            'ref': node['headRefName'],
+            'sha': node['headRefOid'],
+            'repo': {
+                'name': head_repo['name'],
+                'owner': {'login': head_repo['owner']['login']}
+            }
+        },
+        'base': {
+            'ref': node['baseRefName'],
+            'sha': node['baseRef']['target']['oid'],
+            'repo': {
+                'name': target_repo.name,
+                'owner': {'login': target_repo.owner}
+            }
+        }
+    }
 
 
 def overall_review_state(reviews):
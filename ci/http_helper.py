@@ -1,14 +1,17 @@
+from async_http_helper import \
+    github_tokens, \
+    run, \
+    authorized_headers, \
+    checked_output, \
+    get_with_cache, \
+    iter_remaining_pages
 from constants import GITHUB_API_URL
-from environment import oauth_token
-import re
-import requests
+from rate_limit import WEBHOOK
+import async_http_helper
 
-
-class BadStatus(Exception):
-    def __init__(self, data, status_code):
-        Exception.__init__(self, str(data))
-        self.data = data
-        self.status_code = status_code
+# Blocking versions of the coroutines in async_http_helper for callers that
+# are not coroutines themselves. Each one waits for its coroutine on
+# async_http_helper's event loop, so they must never be called from it.
 
 
 def patch_repo(repo,
@@ -18,9 +21,9 @@ def patch_repo(repo,
                data=None,
                status_code=None,
                json_response=True,
-               token=oauth_token):
-    return verb_repo(
-        'patch',
+               token=None,
+               priority=None):
+    return run(async_http_helper.patch_repo(
         repo,
         url,
         headers=headers,
@@ -28,7 +31,8 @@ def patch_repo(repo,
         data=data,
         status_code=status_code,
         json_response=json_response,
-        token=token)
+        token=token,
+        priority=priority))
 
 
 def post_repo(repo,
@@ -38,9 +42,9 @@ def post_repo(repo,
               data=None,
               status_code=None,
               json_response=True,
-              token=oauth_token):
-    return verb_repo(
-        'post',
+              token=None,
+              priority=None):
+    return run(async_http_helper.post_repo(
         repo,
         url,
         headers=headers,
@@ -48,7 +52,8 @@ def post_repo(repo,
         data=data,
         status_code=status_code,
         json_response=json_response,
-        token=token)
+        token=token,
+        priority=priority))
 
 
 def get_repo(repo,
@@ -56,15 +61,16 @@ def get_repo(repo,
              headers=None,
              status_code=None,
              json_response=True,
-             token=oauth_token):
-    return verb_repo(
-        'get',
+             token=None,
+             priority=None):
+    return run(async_http_helper.get_repo(
         repo,
         url,
         headers=headers,
         status_code=status_code,
         json_response=json_response,
-        token=token)
+        token=token,
+        priority=priority))
 
 
 def put_repo(repo,
@@ -74,9 +80,9 @@ def put_repo(repo,
              data=None,
              status_code=None,
              json_response=True,
-             token=oauth_token):
-    return verb_repo(
-        'put',
+             token=None,
+             priority=None):
+    return run(async_http_helper.put_repo(
         repo,
         url,
         headers=headers,
@@ -84,11 +90,16 @@ def put_repo(repo,
         data=data,
         status_code=status_code,
         json_response=json_response,
-        token=token)
+        token=token,
+        priority=priority))
 
 
-def get_github(url, headers=None, status_code=None):
-    return verb_github('get', url, headers=headers, status_code=status_code)
+def get_github(url, headers=None, status_code=None, priority=None):
+    return run(async_http_helper.get_github(
+        url,
+        headers=headers,
+        status_code=status_code,
+        priority=priority))
 
 
 def verb_repo(verb,
@@ -99,23 +110,19 @@ def verb_repo(verb,
               data=None,
               status_code=None,
               json_response=True,
-              token=oauth_token):
-    return verb_github(
+              token=None,
+              priority=None):
+    return run(async_http_helper.verb_repo(
         verb,
-        f'repos/{repo}/{url}',
+        repo,
+        url,
         headers=headers,
         json=json,
         data=data,
         status_code=status_code,
         json_response=json_response,
-        token=token)
-
-
-def implies(antecedent, consequent):
-    return not antecedent or consequent
-
-
-verbs = set(['post', 'put', 'get', 'patch'])
+        token=token,
+        priority=priority))
 
 
 def verb_github(verb,
@@ -125,93 +132,82 @@ def verb_github(verb,
                 data=None,
                 status_code=None,
                 json_response=True,
-                token=oauth_token):
-    if isinstance(status_code, int):
-        status_codes = [status_code]
-    else:
-        status_codes = status_code
-    assert verb in verbs, f'{verb} {verbs}'
-    assert implies(verb == 'post' or verb == 'put',
-                   json is not None or data is not None)
-    assert implies(verb == 'get', json is None and data is None)
-    if headers is None:
-        headers = {}
-    if 'Authorization' in headers:
-        raise ValueError('Header already has Authorization? ' + str(headers))
-    headers['Authorization'] = 'token ' + token
+                token=None,
+                priority=None):
+    return run(async_http_helper.verb_github(
+        verb,
+        url,
+        headers=headers,
+        json=json,
+        data=data,
+        status_code=status_code,
+        json_response=json_response,
+        token=token,
+        priority=priority))
+
+
+# Unlike get_repo, which returns every page of a list at once, iter_repo and
+# iter_github yield the items of one page at a time. If fields is given, each
+# item is projected onto it: a dict from key to either None (keep the whole
+# value) or the fields to keep of a nested dict. Unless prefetch is False,
+# the pages after the first are fetched concurrently, a few at a time.
+def iter_repo(repo,
+              url,
+              headers=None,
+              fields=None,
+              token=None,
+              priority=None,
+              prefetch=True):
+    return iter_github(f'repos/{repo}/{url}',
+                       headers=headers,
+                       fields=fields,
+                       token=token,
+                       priority=priority,
+                       prefetch=prefetch)
+
+
+def iter_github(url, headers=None, fields=None, token=None, priority=None, prefetch=True):
+    if priority is None:
+        priority = WEBHOOK
     full_url = f'{GITHUB_API_URL}{url}'
-    if verb == 'get':
-        r = requests.get(full_url, headers=headers, timeout=5)
-        if json_response:
-            output = r.json()
-            if 'Link' in r.headers:
-                assert isinstance(output, list), output
-                link = r.headers['Link']
-                url = github_link_header_to_maybe_next(link)
-                while url is not None:
-                    r = requests.get(url, headers=headers, timeout=5)
-                    link = r.headers['Link']
-                    output.extend(r.json())
-                    url = github_link_header_to_maybe_next(link)
-        else:
-            output = r.text
-    else:
-        if verb == 'post':
-            r = requests.post(
-                full_url,
-                headers=headers,
-                data=data,
-                json=json,
-                timeout=5)
-        elif verb == 'put':
-            r = requests.put(
-                full_url,
-                headers=headers,
-                data=data,
-                json=json,
-                timeout=5)
-        elif verb == 'patch':
-            r = requests.patch(
-                full_url,
-                headers=headers,
-                data=data,
-                json=json,
-                timeout=5)
-        if json_response:
-            output = r.json()
-        else:
-            output = r.text
-    if status_codes and r.status_code not in status_codes:
-        raise BadStatus({
-            'method': verb,
-            'endpoint': full_url,
-            'status_code': {
-                'actual': r.status_code,
-                'expected': status_codes
-            },
-            'message': 'github error',
-            'data': data,
-            'json': json,
-            'github_json': output
-        },
-                        r.status_code)
-    else:
-        if isinstance(status_code, list):
-            return (output, r.status_code)
-        else:
-            return output
-
-
-github_link = re.compile(r'\s*<(http.+page=[0-9]+)>; rel="([A-z]+)"\s*')
-
-
-def github_link_header_to_maybe_next(link):
-    # I cannot find rigorous documentation on the format, but this seems to
-    # work?
-    link_texts = link.split(',')
-    links = {}
-    for t in link_texts:
-        m = github_link.match(t)
-        assert m is not None, f'{m} {t}'
-        links[m[2]] = m[1]
-    return links.get('next', None)
+    if token is None:
+        token = github_tokens.token_for('get', full_url)
+    headers = authorized_headers(headers, token)
+    r = run(get_with_cache(full_url, headers, token, priority))
+    yield from page_items(full_url, r, fields)
+    pages = iter_remaining_pages(r.headers.get('Link', ''), headers, token, priority,
+                                 prefetch=prefetch)
+    try:
+        while True:
+            page = run(next_page(pages))
+            if page is None:
+                return
+            (url, r) = page
+            yield from page_items(url, r, fields)
+    finally:
+        run(pages.aclose())
+
+
+async def next_page(pages):
+    try:
+        return await pages.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+def page_items(url, r, fields):
+    output = checked_output('get', url, 200, r.status_code, None, None, r.json())
+    assert isinstance(output, list), output
+    if fields is None:
+        return output
+    return [project(item, fields) for item in output]
+
+
+def project(d, fields):
+    if d is None:
+        return None
+    return {
+        k: d[k] if subfields is None else project(d[k], subfields)
+        for k, subfields in fields.items()
+        if k in d
+    }
@@ -0,0 +1,114 @@
+from ci_logging import log
+from environment import IMAGE_CACHE_SIZE, IMAGE_CACHE_FILE
+import collections
+import json
+import os
+import threading
+
+
+class ImageCache(object):
+    # The build image of a (source sha, target sha) pair never changes, so
+    # remember it, including the pairs that have no image because they do not
+    # merge or lack a hail-ci-build-image. If path is set, every new entry is
+    # appended to a log there, which is read back on startup and rewritten
+    # with only the live entries once it grows to twice max_entries lines.
+    def __init__(self, max_entries, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.compactions = 0
+        self._lock = threading.Lock()
+        # held while touching the file, so lookups never wait on the disk
+        self._file_lock = threading.Lock()
+        self._images = collections.OrderedDict()
+        self._logged = 0
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def get(self, source_sha, target_sha):
+        key = (source_sha, target_sha)
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return (True, self._images[key])
+            self.misses += 1
+            return (False, None)
+
+    def put(self, source_sha, target_sha, image):
+        with self._lock:
+            self._images[(source_sha, target_sha)] = image
+            self._images.move_to_end((source_sha, target_sha))
+            while len(self._images) > self.max_entries:
+                self._images.popitem(last=False)
+        if self.path is not None:
+            self._append(source_sha, target_sha, image)
+
+    def _load(self):
+        try:
+            bad_lines = 0
+            with open(self.path, 'r') as f:
+                for line in f:
+                    self._logged += 1
+                    try:
+                        source_sha, target_sha, image = json.loads(line)
+                    except ValueError:
+                        # a write cut short by a crash
+                        log.warning(f'skipping bad line in {self.path}: {line!r}')
+                        bad_lines += 1
+                        continue
+                    self._images[(source_sha, target_sha)] = image
+                    self._images.move_to_end((source_sha, target_sha))
+            while len(self._images) > self.max_entries:
+                self._images.popitem(last=False)
+            log.info(f'loaded {len(self._images)} images from {self.path}')
+            if bad_lines != 0:
+                # otherwise the next append would continue the bad line
+                self._compact()
+        except OSError as e:
+            log.exception(f'could not load images from {self.path} due to {e}')
+            self._images = collections.OrderedDict()
+
+    def _append(self, source_sha, target_sha, image):
+        with self._file_lock:
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps([source_sha, target_sha, image]) + '\n')
+                self._logged += 1
+                if self._logged > 2 * self.max_entries:
+                    self._compact()
+            except OSError as e:
+                log.exception(f'could not save image to {self.path} due to {e}')
+
+    def _compact(self):
+        with self._lock:
+            entries = [[source_sha, target_sha, image]
+                       for (source_sha, target_sha), image in self._images.items()]
+        tmp = f'{self.path}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry) + '\n')
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.exception(f'could not compact {self.path} due to {e}')
+            return
+        self._logged = len(entries)
+        self.compactions += 1
+
+    def to_json(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._images),
+                'max_entries': self.max_entries,
+                'path': self.path,
+                'hits': self.hits,
+                'misses': self.misses,
+                'compactions': self.compactions,
+                'hit_rate': self.hits / lookups if lookups else None
+            }
+
+
+image_cache = ImageCache(IMAGE_CACHE_SIZE, IMAGE_CACHE_FILE)
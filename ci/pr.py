@@ -1,15 +1,19 @@
+from async_http_helper import BadStatus
 from batch.client import Job
 from batch_helper import short_str_build_job
 from build_state import \
     Failure, Mergeable, Unknown, NoImage, Building, Buildable, Merged, \
-    build_state_from_json
+    Submitting, build_state_from_json
+from build_submissions import build_submissions
 from ci_logging import log
 from constants import CONTEXT, BUILD_JOB_TYPE, VERSION, GCS_BUCKET, SHA_LENGTH
 from environment import PR_BUILD_SCRIPT, SELF_HOSTNAME, batch_client
 from git_state import FQSHA, FQRef
+from git_mirror import git_mirrors, git_supports_merge_tree
 from github import latest_sha_for_ref
-from http_helper import get_repo, post_repo, BadStatus
+from image_cache import image_cache
 from sentinel import Sentinel
+from status_queue import github_statuses
 from shell_helper import shell
 import subprocess as sp
 import json
@@ -37,7 +41,12 @@ def review_status(reviews):
 
 
 def try_new_build(source, target):
-    img = maybe_get_image(target, source)
+    build_submissions.submit(source, target, submit_build)
+    return Submitting(target.sha)
+
+
+def submit_build(source, target):
+    img = maybe_get_image(source, target)
     if img:
         attributes = {
             'target': json.dumps(target.to_json()),
@@ -93,6 +102,11 @@ def try_new_build(source, target):
 
 
 def determine_buildability(source, target):
+    build_submissions.submit(source, target, resolve_buildability)
+    return Submitting(target.sha)
+
+
+def resolve_buildability(source, target):
     img = maybe_get_image(source, target)
     if img:
         return Buildable(img, target.sha)
@@ -114,50 +128,97 @@ def get_image_for_target(target):
 def maybe_get_image(source, target):
     assert isinstance(source, FQSHA)
     assert isinstance(target, FQSHA)
-    d = os.getcwd()
-    try:
-        srepo = source.ref.repo
-        trepo = target.ref.repo
-        if not os.path.isdir(trepo.qname):
-            os.makedirs(trepo.qname, exist_ok=True)
-            os.chdir(trepo.qname)
-            shell('git', 'clone', trepo.url, '.')
-        else:
-            os.chdir(trepo.qname)
-        if sp.run(['/bin/sh', '-c', f'git remote | grep -q {srepo.qname}']).returncode != 0:
-            shell('git', 'remote', 'add', srepo.qname, srepo.url)
-        shell('git', 'fetch', 'origin')
-        shell('git', 'fetch', srepo.qname)
-        shell('git', 'checkout', target.sha)
-        shell('git', 'config', 'user.email', 'hail-ci-leader@example.com')
-        shell('git', 'config', 'user.name', 'hail-ci-leader')
-        shell('git', 'merge', source.sha, '-m', 'foo')
+    (hit, img) = image_cache.get(source.sha, target.sha)
+    if hit:
+        return img
+    trepo = target.ref.repo
+    with git_mirrors.using(trepo, [source.ref.repo]):
+        try:
+            path = git_mirrors.fetch(trepo,
+                                     [(trepo, target.sha), (source.ref.repo, source.sha)])
+        except (sp.CalledProcessError, FileNotFoundError) as e:
+            # probably transient, so do not remember it
+            log.exception(f'could not fetch {source.short_str()} and {target.short_str()} due to {e}')
+            return None
+        if not git_mirrors.has_commits(path, [source.sha, target.sha]):
+            log.warning(f'could not find {source.short_str()} or {target.short_str()} after fetching')
+            return None
+        # only a conflict or a missing hail-ci-build-image is remembered as no
+        # image; anything else, like a blob we could not download, may work
+        # next time
+        try:
+            if merge_tree_supported:
+                img = image_from_merge_tree(source, target)
+            else:
+                img = image_from_worktree(source, target)
+        except (sp.CalledProcessError, FileNotFoundError) as e:
+            log.exception(f'could not get hail-ci-build-image due to {e}')
+            return None
+        image_cache.put(source.sha, target.sha, img)
+    return img
+
+
+merge_tree_supported = git_supports_merge_tree()
+
+
+def image_from_merge_tree(source, target):
+    trepo = target.ref.repo
+    if git_mirrors.is_ancestor(trepo, source.sha, target.sha):
+        treeish = target.sha
+    elif git_mirrors.is_ancestor(trepo, target.sha, source.sha):
+        treeish = source.sha
+    else:
+        treeish = git_mirrors.merged_tree(trepo, source.sha, target.sha)
+        if treeish is None:
+            log.info(f'{source.short_str()} does not merge cleanly into {target.short_str()}')
+            return None
+    if not git_mirrors.has_file(trepo, treeish, 'hail-ci-build-image'):
+        log.info(f'no hail-ci-build-image in {source.short_str()} merged into {target.short_str()}')
+        return None
+    return git_mirrors.read_file(trepo, treeish, 'hail-ci-build-image').strip()
+
+
+def image_from_worktree(source, target):
+    with git_mirrors.worktree(target.ref.repo, target.sha) as d:
+        try:
+            shell('git',
+                  '-c', 'user.email=hail-ci-leader@example.com',
+                  '-c', 'user.name=hail-ci-leader',
+                  'merge', source.sha, '-m', 'foo',
+                  cwd=d)
+        except sp.CalledProcessError as e:
+            # git merge exits with 1 on a conflict and 128 when it cannot
+            # run at all
+            if e.returncode == 1:
+                log.info(f'{source.short_str()} does not merge cleanly into {target.short_str()}')
+                return None
+            raise
         # a force push that removes refs could fail us... not sure what we
         # should do in that case. maybe 500'ing is OK?
-        with open('hail-ci-build-image', 'r') as f:
+        image_file = os.path.join(d, 'hail-ci-build-image')
+        if not os.path.exists(image_file):
+            log.info(f'no hail-ci-build-image in {source.short_str()} merged into {target.short_str()}')
+            return None
+        with open(image_file, 'r') as f:
             return f.read().strip()
-    except (sp.CalledProcessError, FileNotFoundError) as e:
-        log.exception(f'could not get hail-ci-build-image due to {e}')
-        return None
-    finally:
-        shell('git', 'reset', '--merge')
-        os.chdir(d)
 
 
 class GitHubPR(object):
-    def __init__(self, state, number, title, source, target_ref, target_sha=None):
+    def __init__(self, state, number, title, source, target_ref, target_sha=None, updated_at=None):
         assert state in ['closed', 'open']
         assert isinstance(number, str), f'{type(number)} {number}'
         assert isinstance(title, str), f'{type(title)} {title}'
         assert isinstance(source, FQSHA), f'{type(source)} {source}'
         assert isinstance(target_ref, FQRef), f'{type(target_ref)} {target_ref}'
         assert target_sha is None or isinstance(target_sha, str), f'{type(target_sha)} {target_sha}'
+        assert updated_at is None or isinstance(updated_at, str), f'{type(updated_at)} {updated_at}'
         self.state = state
         self.number = number
         self.title = title
         self.source = source
         self.target_ref = target_ref
         self.target_sha = target_sha
+        self.updated_at = updated_at
 
     @staticmethod
     def from_gh_json(d, target_sha=None):
@@ -171,7 +232,8 @@ class GitHubPR(object):
                         str(d['title']),
                         FQSHA.from_gh_json(d['head']),
                         FQSHA.from_gh_json(d['base']).ref,
-                        target_sha)
+                        target_sha,
+                        d.get('updated_at', None))
 
     def __str__(self):
         return json.dumps(self.to_json())
@@ -192,7 +254,8 @@ class GitHubPR(object):
             'title': self.title,
             'source': self.source.to_json(),
             'target_ref': self.target_ref.to_json(),
-            'target_sha': self.target_sha
+            'target_sha': self.target_sha,
+            'updated_at': self.updated_at
         }
 
     def to_PR(self, start_build=False):
@@ -270,7 +333,6 @@ class PR(object):
             target=new_target,
             review='pending'
         )._new_build(
-            # FIXME: if I already have an image, just use it
             try_new_build(new_source, new_target)
         )
 
@@ -286,19 +348,20 @@ class PR(object):
             source=new_source,
             review='pending'
         )._new_build(
-            # FIXME: if I already have an image, just use it
             try_new_build(new_source, self.target)
         )
 
     def _new_build(self, new_build):
         if self.build != new_build:
-            self.notify_github(new_build)
+            # GitHub caps the statuses per sha, and Submitting is followed
+            # within seconds by a state worth posting
+            if not isinstance(new_build, Submitting):
+                self.notify_github(new_build)
             return self.copy(build=self.build.transition(new_build))
         else:
             return self
 
     def build_it(self):
-        # FIXME: if I already have an image, just use it
         return self._new_build(try_new_build(self.source, self.target))
 
     # FIXME: this should be a verb
@@ -315,20 +378,7 @@ class PR(object):
         if isinstance(build, Failure) or isinstance(build, Mergeable):
             json['target_url'] = \
                 f'https://storage.googleapis.com/{GCS_BUCKET}/ci/{self.source.sha}/{self.target.sha}/index.html'
-        try:
-            post_repo(
-                self.target.ref.repo.qname,
-                'statuses/' + self.source.sha,
-                json=json,
-                status_code=201)
-        except BadStatus as e:
-            if e.status_code == 422:
-                log.exception(
-                    f'Too many statuses applied to {self.source.sha}! This is a '
-                    f'dangerous situation because I can no longer block merging '
-                    f'of failing PRs.')
-            else:
-                raise e
+        github_statuses.post(self.target.ref.repo.qname, self.source.sha, json)
 
     @staticmethod
     def fresh(source, target, number=None, title=None):
@@ -378,7 +428,7 @@ class PR(object):
         return self.review == 'approved'
 
     def is_running(self):
-        return isinstance(self.build, Building)
+        return isinstance(self.build, Building) or isinstance(self.build, Submitting)
 
     def is_pending_build(self):
         return isinstance(self.build, Buildable)
@@ -455,6 +505,12 @@ class PR(object):
                 job.delete()
                 return self
 
+    def is_submitting(self):
+        return isinstance(self.build, Submitting)
+
+    def update_from_submitted_build(self, build):
+        return self._new_build(build)
+
     def update_from_completed_batch_job(self, job):
         assert isinstance(job, Job)
         job_status = job.cached_status()
@@ -1,5 +1,6 @@
 from batch.client import Job
-from batch_helper import short_str_build_job
+from batch_helper import short_str_build_job, try_to_cancel_job
+from build_state import Buildable, Building, NoImage
 from ci_logging import log
 from constants import VERSION, DEPLOY_JOB_TYPE
 from environment import \
@@ -10,6 +11,7 @@ from git_state import FQRef, FQSHA, Repo
 from github import latest_sha_for_ref
 from http_helper import put_repo
 from pr import PR, GitHubPR, get_image_for_target
+from rate_limit import MERGE
 import json
 
 
@@ -23,6 +25,11 @@ class PRS(object):
             for ref, deployable in _watched_targets.items() if deployable
         }
         self.deploy_jobs = {}
+        # targets that changed since they were last healed
+        self.dirty_targets = set()
+        self.full_heals = 0
+        self.dirty_heals = 0
+        self.healed_targets = 0
 
     def _set(self, source, target, pr):
         assert isinstance(source, FQRef), source
@@ -35,6 +42,13 @@ class PRS(object):
         self.target_source_pr[target][source] = pr
         self.source_target_pr[source][target] = pr
 
+    # like _set, but only marks the target dirty when the PR actually changed
+    def _update(self, old_pr, pr):
+        assert isinstance(pr, PR), pr
+        self._set(pr.source.ref, pr.target.ref, pr)
+        if old_pr is None or old_pr.to_json() != pr.to_json():
+            self.mark_dirty(pr.target.ref)
+
     def _get(self, source=None, target=None, default=None):
         if source is None:
             assert isinstance(target, FQRef), target
@@ -103,6 +117,14 @@ class PRS(object):
         return [x for x in self.target_source_pr.keys()
                 if x.repo == repo]
 
+    # the part of our state that GitHub webhooks should keep up to date
+    def github_fingerprint(self, repo):
+        return {
+            (source, target): (pr.source.sha, pr.target.sha, pr.review)
+            for target in self.live_target_refs_for_repo(repo)
+            for source, pr in self.target_source_pr[target].items()
+        }
+
     def for_target(self, target):
         return self.target_source_pr.get(target, {}).values()
 
@@ -114,17 +136,47 @@ class PRS(object):
         assert action in ('unwatch', 'watch', 'deploy')
         if action == 'unwatch':
             del self._watched_targets[target_ref]
+            self.dirty_targets.discard(target_ref)
         elif action == 'watch':
             self._watched_targets[target_ref] = False
+            self.mark_dirty(target_ref)
         else:
             self._watched_targets[target_ref] = True
             if target_ref not in self.latest_deployed:
                 self.latest_deployed[target_ref] = None
+            self.mark_dirty(target_ref)
+
+    def mark_dirty(self, target):
+        assert isinstance(target, FQRef), target
+        self.dirty_targets.add(target)
 
     def heal(self):
-        for target in self.watched_target_refs():
+        self.full_heals += 1
+        self.dirty_targets = set()
+        for target in list(self.watched_target_refs()):
+            self.healed_targets += 1
             self.heal_target(target)
 
+    def heal_dirty(self):
+        if len(self.dirty_targets) == 0:
+            return
+        self.dirty_heals += 1
+        targets = self.dirty_targets
+        self.dirty_targets = set()
+        for target in targets:
+            if not self.is_watched_target_ref(target):
+                continue
+            self.healed_targets += 1
+            self.heal_target(target)
+
+    def heal_stats(self):
+        return {
+            'dirty_targets': len(self.dirty_targets),
+            'full_heals': self.full_heals,
+            'dirty_heals': self.dirty_heals,
+            'healed_targets': self.healed_targets
+        }
+
     def heal_target(self, target):
         assert isinstance(target, FQRef)
         ready_to_merge = self.ready_to_merge(target)
@@ -242,29 +294,24 @@ class PRS(object):
     def push(self, new_target):
         assert isinstance(new_target, FQSHA), new_target
         if self.is_watched_target_ref(new_target.ref):
-            if self.is_deployable_target_ref(new_target.ref):
-                self.try_deploy(new_target.ref)
-            else:
-                log.info(f'not deploying target {new_target.short_str()}')
-        prs = self._get(target=new_target.ref).values()
+            # healing a deployable target deploys it
+            self.mark_dirty(new_target.ref)
+        prs = list(self._get(target=new_target.ref).values())
         if len(prs) == 0:
             log.info(f'no PRs for target {new_target.ref.short_str()}')
         else:
             for pr in prs:
-                self._set(pr.source.ref,
-                          pr.target.ref,
-                          pr.update_from_github_push(new_target))
-            self.heal_target(new_target.ref)
+                self._update(pr, pr.update_from_github_push(new_target))
 
     def pr_push(self, gh_pr):
         assert isinstance(gh_pr, GitHubPR), gh_pr
-        pr = self._get(gh_pr.source.ref, gh_pr.target_ref)
-        if pr is None:
+        old_pr = self._get(gh_pr.source.ref, gh_pr.target_ref)
+        if old_pr is None:
             log.warning(f'found new PR {gh_pr.short_str()}')
             pr = gh_pr.to_PR(start_build=True)
         else:
-            pr = pr.update_from_github_pr(gh_pr)
-        self._set(gh_pr.source.ref, gh_pr.target_ref, pr)
+            pr = old_pr.update_from_github_pr(gh_pr)
+        self._update(old_pr, pr)
 
     def forget_target(self, target):
         assert isinstance(target, FQRef), f'{type(target)} {target}'
@@ -272,23 +319,24 @@ class PRS(object):
         for source in sources:
             x = self.source_target_pr[source]
             del x[target]
+        self.dirty_targets.discard(target)
 
     def forget(self, source, target):
         assert isinstance(source, FQRef)
         assert isinstance(target, FQRef)
-        self._pop(source, target)
+        if self._pop(source, target) is not None:
+            self.mark_dirty(target)
 
     def review(self, gh_pr, state):
         assert isinstance(gh_pr, GitHubPR), gh_pr
         assert state in ['pending', 'approved', 'changes_requested']
-        pr = self._get(gh_pr.source.ref, gh_pr.target_ref)
-        if pr is None:
+        old_pr = self._get(gh_pr.source.ref, gh_pr.target_ref)
+        if old_pr is None:
             log.warning(f'found new PR during review update {gh_pr.short_str()}')
             pr = gh_pr.to_PR(start_build=True)
-        pr = pr.update_from_github_review_state(state)
-        self._set(gh_pr.source.ref, gh_pr.target_ref, pr)
-        if pr.is_mergeable():
-            self.heal_target(gh_pr.target_ref)
+        else:
+            pr = old_pr
+        self._update(old_pr, pr.update_from_github_review_state(state))
 
     def deploy_build_finished(self, target, job):
         assert isinstance(target, FQSHA)
@@ -309,6 +357,8 @@ class PRS(object):
             log.info(f'deploy job {job.id} succeeded for {target.short_str()}')
             self.latest_deployed[target.ref] = target.sha
         job.delete()
+        # the target may have moved on while we were deploying
+        self.mark_dirty(target.ref)
 
     def refresh_from_deploy_job(self, target, job):
         assert isinstance(job, Job), job
@@ -344,8 +394,35 @@ class PRS(object):
         self._set(source.ref,
                   target.ref,
                   pr.update_from_completed_batch_job(job))
-        # eagerly heal because a finished job might mean new work to do
-        self.heal_target(target.ref)
+        # a finished job might mean new work to do
+        self.mark_dirty(target.ref)
+
+    def build_submitted(self, source, target, build):
+        assert isinstance(source, FQSHA), source
+        assert isinstance(target, FQSHA), target
+        pr = self._get(source.ref, target.ref)
+        if pr is None or pr.source != source or pr.target != target:
+            log.info(f'discarding build {build} of {source.short_str()} into '
+                     f'{target.short_str()}, the PR has moved on')
+            if isinstance(build, Building):
+                try_to_cancel_job(build.job)
+            return
+        if not pr.is_submitting():
+            # a batch refresh already found the job, and maybe saw it finish,
+            # or a buildability check of the same PR finished first
+            if isinstance(build, Building):
+                if isinstance(pr.build, Building):
+                    if build != pr.build:
+                        log.info(f'discarding duplicate build {build} of {pr.short_str()}')
+                        try_to_cancel_job(build.job)
+                elif isinstance(pr.build, Buildable) or isinstance(pr.build, NoImage):
+                    self._update(pr, pr.update_from_submitted_build(build))
+            return
+        if build is None:
+            # the submission itself broke; wait for a new source or target
+            # rather than retrying in a loop
+            build = NoImage(target.sha)
+        self._update(pr, pr.update_from_submitted_build(build))
 
     def refresh_from_ci_job(self, source, target, job):
         assert isinstance(job, Job), job
@@ -359,18 +436,18 @@ class PRS(object):
             return
         assert source.sha == pr.source.sha, f'{source} {pr}'
         assert target.sha == pr.target.sha, f'{target} {pr}'
-        self._set(source.ref, target.ref, pr.refresh_from_batch_job(job))
+        self._update(pr, pr.refresh_from_batch_job(job))
 
     def refresh_from_github_build_status(self, gh_pr, status):
         assert isinstance(gh_pr, GitHubPR), gh_pr
-        pr = self._get(gh_pr.source.ref, gh_pr.target_ref)
-        if pr is None:
+        old_pr = self._get(gh_pr.source.ref, gh_pr.target_ref)
+        if old_pr is None:
             log.warning(
                 f'found new PR during GitHub build status update {gh_pr.short_str()}')
             pr = gh_pr.to_PR()
-        self._set(gh_pr.source.ref,
-                  gh_pr.target_ref,
-                  pr.update_from_github_status(status))
+        else:
+            pr = old_pr
+        self._update(old_pr, pr.update_from_github_status(status))
 
     def build(self, source, target):
         assert isinstance(source, FQRef)
@@ -379,6 +456,7 @@ class PRS(object):
         if pr is None:
             raise ValueError(f'no such pr {source.short_str()} {target.short_str()}')
         self._set(source, target, pr.build_it())
+        self.mark_dirty(target)
 
     def merge(self, pr):
         assert isinstance(pr, PR)
@@ -390,7 +468,8 @@ class PRS(object):
                  'merge_method': 'squash',
                  'sha': pr.source.sha
              },
-             status_code=[200, 409])
+             status_code=[200, 409],
+             priority=MERGE)
         if status_code == 200:
             log.info(f'successful merge of {pr.short_str()}')
             self._set(pr.source.ref, pr.target.ref, pr.merged())
@@ -0,0 +1,169 @@
+import collections
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+
+# lower numbers go first
+MERGE = 0
+STATUS = 1
+WEBHOOK = 2
+REFRESH = 3
+
+priority_names = {
+    MERGE: 'merge',
+    STATUS: 'status',
+    WEBHOOK: 'webhook',
+    REFRESH: 'refresh'
+}
+
+# a request of a given priority is held back once the remaining budget falls
+# to this fraction of the hourly limit, so background work cannot starve
+# merges and status posts
+reserves = {
+    MERGE: 0.0,
+    STATUS: 0.01,
+    WEBHOOK: 0.05,
+    REFRESH: 0.2
+}
+
+# these priorities are dropped rather than held back, the next refresh cycle
+# will try again anyway
+shed_priorities = {REFRESH}
+
+
+class RateLimited(Exception):
+    def __init__(self, priority, delay):
+        Exception.__init__(
+            self,
+            f'GitHub rate limit too low for {priority_names[priority]} '
+            f'requests, would need to wait {delay:.0f} seconds')
+        self.priority = priority
+        self.delay = delay
+
+
+def token_label(token):
+    return 'token-' + hashlib.sha256(token.encode('utf-8')).hexdigest()[:8]
+
+
+class Budget(object):
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.retry_after_until = 0
+        self.waiting = []
+
+    def delay(self, priority, now):
+        if self.retry_after_until > now:
+            return self.retry_after_until - now
+        if self.remaining is None or self.limit is None:
+            return 0
+        if self.reset is not None and self.reset <= now:
+            # the window rolled over, optimistically assume a full budget
+            # until the next response tells us otherwise
+            self.remaining = self.limit
+            self.reset = None
+            return 0
+        if self.remaining > reserves[priority] * self.limit:
+            return 0
+        if self.reset is None:
+            return float('inf')
+        return self.reset - now
+
+    def to_json(self):
+        return {
+            'limit': self.limit,
+            'remaining': self.remaining,
+            'reset': self.reset,
+            'retry_after_until': self.retry_after_until,
+            'queue_depth': {
+                priority_names[priority]: len([
+                    x for x in self.waiting if x[0] == priority])
+                for priority in priority_names
+            }
+        }
+
+
+class RateLimitScheduler(object):
+    def __init__(self, max_wait_in_seconds):
+        self.max_wait_in_seconds = max_wait_in_seconds
+        self.labels = {}
+        self.deferred = collections.Counter()
+        self.shed = collections.Counter()
+        self._cond = threading.Condition()
+        self._budgets = {}
+        self._counter = itertools.count()
+
+    # GitHub budgets the REST API and the GraphQL API separately
+    def _budget(self, token, resource):
+        budget = self._budgets.get((token, resource), None)
+        if budget is None:
+            budget = Budget()
+            self._budgets[(token, resource)] = budget
+        return budget
+
+    def budget(self, token, resource='core'):
+        with self._cond:
+            budget = self._budget(token, resource)
+            budget.delay(REFRESH, time.time())
+            return budget.remaining
+
+    def acquire(self, token, priority, resource='core'):
+        assert priority in priority_names, priority
+        with self._cond:
+            budget = self._budget(token, resource)
+            now = time.time()
+            delay = budget.delay(priority, now)
+            if delay > 0:
+                if priority in shed_priorities or delay > self.max_wait_in_seconds:
+                    self.shed[priority_names[priority]] += 1
+                    raise RateLimited(priority, delay)
+                self.deferred[priority_names[priority]] += 1
+            entry = (priority, next(self._counter))
+            heapq.heappush(budget.waiting, entry)
+            deadline = now + self.max_wait_in_seconds
+            try:
+                while True:
+                    now = time.time()
+                    delay = budget.delay(priority, now)
+                    if delay == 0 and budget.waiting[0] == entry:
+                        break
+                    if now >= deadline:
+                        self.shed[priority_names[priority]] += 1
+                        raise RateLimited(priority, delay)
+                    self._cond.wait(min(deadline - now, max(delay, 0.1)))
+            finally:
+                budget.waiting.remove(entry)
+                heapq.heapify(budget.waiting)
+                self._cond.notify_all()
+            if budget.remaining is not None:
+                budget.remaining -= 1
+
+    def update(self, token, r, resource='core'):
+        with self._cond:
+            budget = self._budget(token, resource)
+            headers = r.headers
+            if 'X-RateLimit-Limit' in headers:
+                budget.limit = int(headers['X-RateLimit-Limit'])
+            if 'X-RateLimit-Remaining' in headers:
+                budget.remaining = int(headers['X-RateLimit-Remaining'])
+            if 'X-RateLimit-Reset' in headers:
+                budget.reset = int(headers['X-RateLimit-Reset'])
+            if 'Retry-After' in headers:
+                budget.retry_after_until = \
+                    time.time() + int(headers['Retry-After'])
+            self._cond.notify_all()
+
+    def to_json(self):
+        with self._cond:
+            return {
+                'budgets': {
+                    f'{self.labels.get(token, token_label(token))}:{resource}':
+                    budget.to_json()
+                    for (token, resource), budget in self._budgets.items()
+                },
+                'deferred': dict(self.deferred),
+                'shed': dict(self.shed)
+            }
@@ -0,0 +1,138 @@
+from ci_logging import log
+import random
+import threading
+import time
+
+# how an adaptive phase's interval reacts to a run that found, or did not
+# find, drift
+SHRINK_ON_DRIFT = 0.5
+GROW_WITHOUT_DRIFT = 1.5
+
+
+class Phase(object):
+    def __init__(self,
+                 name,
+                 f,
+                 interval_in_seconds,
+                 jitter_in_seconds,
+                 min_interval_in_seconds=None,
+                 max_interval_in_seconds=None):
+        self.name = name
+        self.f = f
+        self.interval_in_seconds = interval_in_seconds
+        self.jitter_in_seconds = jitter_in_seconds
+        self.min_interval_in_seconds = \
+            interval_in_seconds if min_interval_in_seconds is None else min_interval_in_seconds
+        self.max_interval_in_seconds = \
+            interval_in_seconds if max_interval_in_seconds is None else max_interval_in_seconds
+        self.drifted_runs = 0
+        self.quiet_runs = 0
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_started = None
+        self.last_duration = None
+        self.max_duration = None
+        self.total_duration = 0.0
+        self._running = threading.Lock()
+
+    def run_once(self):
+        # never run a phase twice at once, e.g. when someone POSTs to
+        # /refresh_github_state while the scheduled refresh is still going
+        if not self._running.acquire(blocking=False):
+            log.info(f'not running {self.name}, it is already running')
+            self.skipped += 1
+            return False
+        try:
+            start = time.time()
+            self.last_started = start
+            try:
+                drift = self.f()
+                if drift is not None:
+                    self.adapt(drift)
+            except Exception as e:
+                log.exception(f'{self.name} failed due to {e}')
+                self.failures += 1
+            duration = time.time() - start
+            self.runs += 1
+            self.last_duration = duration
+            self.max_duration = max(self.max_duration or 0.0, duration)
+            self.total_duration += duration
+            log.info(f'{self.name} took {duration:.2f} seconds')
+            return True
+        finally:
+            self._running.release()
+
+    # a phase may return how much drift it found, i.e. how many things it
+    # fixed that nobody told us about; drift means we should look more often,
+    # no drift means we can afford to look less often
+    def adapt(self, drift):
+        if drift > 0:
+            self.drifted_runs += 1
+            interval = self.interval_in_seconds * SHRINK_ON_DRIFT
+        else:
+            self.quiet_runs += 1
+            interval = self.interval_in_seconds * GROW_WITHOUT_DRIFT
+        interval = min(max(interval, self.min_interval_in_seconds),
+                       self.max_interval_in_seconds)
+        if interval != self.interval_in_seconds:
+            log.info(f'{self.name} found drift {drift}, changing interval from '
+                     f'{self.interval_in_seconds:.0f} to {interval:.0f} seconds')
+            self.interval_in_seconds = interval
+
+    def sleep_time(self):
+        return self.interval_in_seconds + random.uniform(0, self.jitter_in_seconds)
+
+    def loop(self):
+        time.sleep(random.uniform(0, self.jitter_in_seconds))
+        while True:
+            self.run_once()
+            time.sleep(self.sleep_time())
+
+    def to_json(self):
+        return {
+            'interval_in_seconds': self.interval_in_seconds,
+            'min_interval_in_seconds': self.min_interval_in_seconds,
+            'max_interval_in_seconds': self.max_interval_in_seconds,
+            'jitter_in_seconds': self.jitter_in_seconds,
+            'drifted_runs': self.drifted_runs,
+            'quiet_runs': self.quiet_runs,
+            'running': self._running.locked(),
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'failures': self.failures,
+            'last_started': self.last_started,
+            'last_duration': self.last_duration,
+            'max_duration': self.max_duration,
+            'mean_duration': self.total_duration / self.runs if self.runs else None
+        }
+
+
+class RefreshScheduler(object):
+    # runs each phase of the polling loop on its own thread and interval
+    def __init__(self):
+        self.phases = {}
+
+    def add(self,
+            name,
+            f,
+            interval_in_seconds,
+            jitter_in_seconds,
+            min_interval_in_seconds=None,
+            max_interval_in_seconds=None):
+        self.phases[name] = Phase(name,
+                                  f,
+                                  interval_in_seconds,
+                                  jitter_in_seconds,
+                                  min_interval_in_seconds,
+                                  max_interval_in_seconds)
+
+    def start(self):
+        for phase in self.phases.values():
+            threading.Thread(target=phase.loop, daemon=True).start()
+
+    def run_now(self, name):
+        return self.phases[name].run_once()
+
+    def to_json(self):
+        return {name: phase.to_json() for name, phase in self.phases.items()}
@@ -9,5 +9,6 @@ setup(
     description='Description of my package',
     packages=find_packages(),
     install_requires=['requests',
+                      'aiohttp',
                       'flask'],
 )
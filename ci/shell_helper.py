@@ -1,5 +1,9 @@
 import subprocess as sp
 
 
-def shell(*args):
-    sp.run(args, capture_output=True, check=True)
+def shell(*args, cwd=None):
+    return sp.run(args, capture_output=True, check=True, cwd=cwd).stdout.decode('utf-8')
+
+
+def succeeds(*args, cwd=None):
+    return sp.run(args, capture_output=True, cwd=cwd).returncode == 0
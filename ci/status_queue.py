@@ -0,0 +1,109 @@
+from async_http_helper import BadStatus
+from ci_logging import log
+from environment import GITHUB_STATUS_PARALLELISM
+from http_helper import post_repo
+from rate_limit import STATUS
+import collections
+import threading
+
+MAX_ATTEMPTS = 3
+
+
+class StatusQueue(object):
+    # Commit statuses are posted in the background. Only the newest status for
+    # a given (repo, sha, context) matters, so a status that has not been sent
+    # yet is simply replaced when a newer one arrives. At most one status per
+    # key is in flight at a time, so GitHub always ends with the newest one.
+    def __init__(self, parallelism):
+        self.parallelism = parallelism
+        self.enqueued = 0
+        self.superseded = 0
+        self.posted = 0
+        self.failed = 0
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._in_flight = set()
+        for _ in range(parallelism):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def post(self, repo, sha, json):
+        key = (repo, sha, json['context'])
+        with self._cond:
+            self.enqueued += 1
+            if key in self._pending:
+                self.superseded += 1
+            self._pending[key] = (json, 1)
+            self._cond.notify()
+
+    def _next(self):
+        for key in self._pending:
+            if key not in self._in_flight:
+                return key
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                key = self._next()
+                while key is None:
+                    self._cond.wait()
+                    key = self._next()
+                (json, attempts) = self._pending.pop(key)
+                self._in_flight.add(key)
+            try:
+                self._post(key, json, attempts)
+            finally:
+                with self._cond:
+                    self._in_flight.remove(key)
+                    self._cond.notify_all()
+
+    def _post(self, key, json, attempts):
+        (repo, sha, _) = key
+        try:
+            post_repo(
+                repo,
+                'statuses/' + sha,
+                json=json,
+                status_code=201,
+                priority=STATUS)
+            with self._cond:
+                self.posted += 1
+        except BadStatus as e:
+            with self._cond:
+                self.failed += 1
+            if e.status_code == 422:
+                log.exception(
+                    f'Too many statuses applied to {sha}! This is a '
+                    f'dangerous situation because I can no longer block merging '
+                    f'of failing PRs.')
+            else:
+                self._retry(key, json, attempts, e)
+        except Exception as e:
+            with self._cond:
+                self.failed += 1
+            self._retry(key, json, attempts, e)
+
+    def _retry(self, key, json, attempts, e):
+        with self._cond:
+            if key in self._pending:
+                log.info(f'not retrying status for {key}, a newer one is pending')
+            elif attempts >= MAX_ATTEMPTS:
+                log.error(f'giving up on status {json} for {key} due to {e}')
+            else:
+                log.warning(f'will retry status {json} for {key} due to {e}')
+                self._pending[key] = (json, attempts + 1)
+
+    def to_json(self):
+        with self._cond:
+            return {
+                'parallelism': self.parallelism,
+                'pending': len(self._pending),
+                'in_flight': len(self._in_flight),
+                'enqueued': self.enqueued,
+                'superseded': self.superseded,
+                'posted': self.posted,
+                'failed': self.failed
+            }
+
+
+github_statuses = StatusQueue(GITHUB_STATUS_PARALLELISM)
@@ -0,0 +1,81 @@
+from ci_logging import log
+import collections
+import threading
+
+
+class Webhooks(object):
+    # GitHub redelivers webhooks, so we remember the last few delivery ids
+    # and drop repeats. Developers also push several commits in a row, so
+    # events about the same branch or PR are held for a short window and only
+    # the newest one is applied. timer is called like threading.Timer to
+    # end the window.
+    def __init__(self, event_loop, window_in_seconds, max_deliveries, timer=threading.Timer):
+        self.event_loop = event_loop
+        self.window_in_seconds = window_in_seconds
+        self.max_deliveries = max_deliveries
+        self.timer = timer
+        self.received = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._deliveries = collections.OrderedDict()
+        self._pending = {}
+
+    def is_duplicate(self, delivery_id):
+        with self._lock:
+            self.received += 1
+            if delivery_id is None:
+                return False
+            if delivery_id in self._deliveries:
+                self._deliveries.move_to_end(delivery_id)
+                self.dropped += 1
+                log.info(f'dropping duplicate webhook delivery {delivery_id}')
+                return True
+            self._deliveries[delivery_id] = None
+            if len(self._deliveries) > self.max_deliveries:
+                self._deliveries.popitem(last=False)
+            return False
+
+    def submit(self, key, event):
+        if self.window_in_seconds <= 0:
+            self.event_loop.submit(event)
+            return
+        with self._lock:
+            if key in self._pending:
+                log.info(f'{event} supersedes {self._pending[key][0]}')
+                self.coalesced += 1
+                self._pending[key][0] = event
+                return
+            pending = [event, None]
+            timer = self.timer(self.window_in_seconds, self._flush, [key, pending])
+            timer.daemon = True
+            pending[1] = timer
+            self._pending[key] = pending
+        timer.start()
+
+    # Submits event right away, but only after anything held for key, so that
+    # it is not applied before an earlier webhook about the same thing.
+    def submit_now(self, key, event):
+        with self._lock:
+            pending = self._pending.pop(key, None)
+            if pending is not None:
+                pending[1].cancel()
+                self.event_loop.submit(pending[0])
+            self.event_loop.submit(event)
+
+    def _flush(self, key, pending):
+        with self._lock:
+            # submit_now may have beaten us to it
+            if self._pending.get(key, None) is pending:
+                del self._pending[key]
+                self.event_loop.submit(pending[0])
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'window_in_seconds': self.window_in_seconds,
+                'received': self.received,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'pending': len(self._pending)
+            }
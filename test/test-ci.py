@@ -1,6 +1,7 @@
 from http_helper import get_repo, post_repo, patch_repo
 from pr import PR
 from subprocess import call, run
+import contextlib
 import inspect
 import json
 import os
@@ -8,6 +9,7 @@ import pkg_resources
 import requests
 import subprocess
 import tempfile
+import threading
 import time
 import unittest
 
@@ -101,6 +103,60 @@ def dictKVMismatches(actual, kvs):
     return errors
 
 
+class FakeBuilds(object):
+    # stands in for everything outside of PRS that a build submission
+    # touches: the submission pool, batch, and the GitHub status queue
+    def __init__(self):
+        self.submitted = []
+        self.statuses = []
+        self.cancelled = []
+        self.jobs = 0
+
+    def submit(self, source, target, f):
+        self.submitted.append((source, target, f))
+
+    def post(self, repo, sha, json):
+        self.statuses.append(json['state'])
+
+    def create_job(self, image, attributes, **kwargs):
+        self.jobs += 1
+        return self.job(self.jobs, attributes)
+
+    def job(self, id, attributes):
+        from batch.client import Job
+        return Job(None, id, attributes=attributes, _status={'state': 'Created'})
+
+    # runs the i-th submission and hands its result to PRS, as the
+    # submission pool and the event loop would
+    def finish(self, prs, i):
+        from events import BuildSubmitted
+        (source, target, f) = self.submitted[i]
+        BuildSubmitted(source, target, f(source, target)).apply(prs)
+
+    @contextlib.contextmanager
+    def installed(self):
+        import build_state
+        import pr
+        import prs
+
+        patches = [
+            (pr, 'build_submissions', self),
+            (pr, 'batch_client', self),
+            (pr, 'github_statuses', self),
+            (pr, 'maybe_get_image', lambda source, target: 'gcr.io/hail-vdc/hail-pr-builder:1'),
+            (prs, 'try_to_cancel_job', self.cancelled.append),
+            (build_state, 'try_to_cancel_job', self.cancelled.append)
+        ]
+        old = [(module, name, getattr(module, name)) for (module, name, _) in patches]
+        for (module, name, value) in patches:
+            setattr(module, name, value)
+        try:
+            yield self
+        finally:
+            for (module, name, value) in old:
+                setattr(module, name, value)
+
+
 ###############################################################################
 
 
@@ -119,6 +175,542 @@ class TestCILocally(unittest.TestCase):
         assert review_state['reviews']['cseed'] == 'APPROVED'
         assert 'tpoterba' not in review_state['reviews']
 
+    def test_graphql_pull_matches_rest_shape(self):
+        from git_state import Repo
+        from github import gh_json_from_graphql_pull
+        from pr import GitHubPR
+
+        node = {
+            'number': 42,
+            'title': 'foo',
+            'headRefName': 'bar',
+            'headRefOid': 'a' * 40,
+            'headRepository': {'name': 'hail', 'owner': {'login': 'danking'}},
+            'baseRefName': 'master',
+            'baseRef': {'target': {'oid': 'b' * 40}}
+        }
+        gh_pr = GitHubPR.from_gh_json(
+            gh_json_from_graphql_pull(Repo('hail-is', 'hail'), node),
+            'b' * 40)
+
+        assert gh_pr.number == '42'
+        assert gh_pr.source.ref.short_str() == 'danking/hail:bar'
+        assert gh_pr.source.sha == 'a' * 40
+        assert gh_pr.target_ref.short_str() == 'hail-is/hail:master'
+        assert gh_pr.target_sha == 'b' * 40
+
+        node['headRepository'] = None
+        assert gh_json_from_graphql_pull(Repo('hail-is', 'hail'), node) is None
+
+    def test_rate_limit_reserves_by_priority(self):
+        from rate_limit import \
+            RateLimitScheduler, RateLimited, MERGE, STATUS, WEBHOOK, REFRESH
+
+        class Response(object):
+            def __init__(self, remaining):
+                self.headers = {
+                    'X-RateLimit-Limit': '1000',
+                    'X-RateLimit-Remaining': str(remaining),
+                    'X-RateLimit-Reset': str(int(time.time()) + 3600)
+                }
+
+        scheduler = RateLimitScheduler(0)
+        for (priority, reserve) in [(REFRESH, 200), (WEBHOOK, 50), (STATUS, 10), (MERGE, 0)]:
+            scheduler.update('token', Response(reserve + 1))
+            scheduler.acquire('token', priority)
+            with self.assertRaises(RateLimited):
+                scheduler.acquire('token', priority)
+
+        scheduler.update('token', Response(100))
+        with self.assertRaises(RateLimited):
+            scheduler.acquire('token', REFRESH)
+        scheduler.acquire('token', MERGE)
+        assert scheduler.budget('token') == 99
+        assert scheduler.shed['refresh'] == 2
+
+    def test_status_queue_posts_only_the_newest_status(self):
+        import status_queue
+
+        lock = threading.Lock()
+        started = threading.Event()
+        release = threading.Event()
+        done = threading.Event()
+        in_flight = []
+        max_in_flight = [0]
+        posted = []
+
+        def post_repo(repo, url, json, status_code, priority):
+            with lock:
+                in_flight.append(url)
+                max_in_flight[0] = max(max_in_flight[0], in_flight.count(url))
+            started.set()
+            assert release.wait(5)
+            with lock:
+                in_flight.remove(url)
+                posted.append(json['description'])
+                if len(posted) == 2:
+                    done.set()
+
+        def status(description):
+            return {'state': 'pending', 'description': description, 'context': 'ci'}
+
+        old_post_repo = status_queue.post_repo
+        status_queue.post_repo = post_repo
+        try:
+            statuses = status_queue.StatusQueue(4)
+            statuses.post('hail-is/hail', 'a' * 40, status('1'))
+            assert started.wait(5)
+            statuses.post('hail-is/hail', 'a' * 40, status('2'))
+            statuses.post('hail-is/hail', 'a' * 40, status('3'))
+            # the idle workers must leave 3 alone while 1 is in flight
+            with statuses._cond:
+                assert statuses._next() is None
+                assert len(statuses._pending) == 1
+            release.set()
+            assert done.wait(5)
+            assert posted == ['1', '3']
+            assert max_in_flight[0] == 1
+            assert statuses.to_json()['superseded'] == 1
+        finally:
+            status_queue.post_repo = old_post_repo
+
+    def test_webhooks_drop_redeliveries_and_coalesce(self):
+        from webhooks import Webhooks
+
+        class EventLoop(object):
+            def __init__(self):
+                self.events = []
+
+            def submit(self, event):
+                self.events.append(event)
+
+        # windows end when the test says so
+        timers = []
+
+        class Timer(object):
+            def __init__(self, interval, function, args):
+                self.function = function
+                self.args = args
+                self.cancelled = False
+                timers.append(self)
+
+            def start(self):
+                pass
+
+            def cancel(self):
+                self.cancelled = True
+
+            def fire(self):
+                self.function(*self.args)
+
+        event_loop = EventLoop()
+        webhooks = Webhooks(event_loop, 0.1, 2, timer=Timer)
+        assert not webhooks.is_duplicate('1')
+        assert webhooks.is_duplicate('1')
+        assert not webhooks.is_duplicate('2')
+        assert not webhooks.is_duplicate('3')
+        # only the last two deliveries are remembered
+        assert not webhooks.is_duplicate('1')
+        assert not webhooks.is_duplicate(None)
+        assert not webhooks.is_duplicate(None)
+
+        webhooks.submit('a', 'push 1')
+        webhooks.submit('a', 'push 2')
+        webhooks.submit('b', 'push 3')
+        assert event_loop.events == []
+        assert len(timers) == 2
+        for timer in timers:
+            timer.fire()
+        assert event_loop.events == ['push 2', 'push 3']
+
+        # a review never overtakes a push that is still held back
+        webhooks.submit('a', 'push 4')
+        webhooks.submit_now('a', 'review')
+        assert event_loop.events[2:] == ['push 4', 'review']
+        assert timers[2].cancelled
+        # nor is the push submitted again by a timer that fired anyway
+        webhooks.submit('a', 'push 5')
+        timers[2].fire()
+        assert event_loop.events[4:] == []
+        timers[3].fire()
+        assert event_loop.events[4:] == ['push 5']
+        assert webhooks.to_json()['coalesced'] == 1
+        assert webhooks.to_json()['pending'] == 0
+
+    def test_github_requests_wait_for_the_pool_without_timing_out(self):
+        import async_http_helper
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Slow(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(0.05)
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'[]')
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Slow)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            # 40 requests through 2 connections take about a second, far
+            # longer than any one of them may take
+            session = async_http_helper.PooledSession(2, True, timeout_in_seconds=0.5)
+            url = f'http://127.0.0.1:{server.server_port}/'
+            results = async_http_helper.run_all([session.request('get', url)
+                                                 for _ in range(40)])
+            assert all(r.status_code == 200 for r in results)
+
+            running = [0, 0]
+
+            async def get(i):
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+                try:
+                    if i % 10 == 0:
+                        raise ValueError(i)
+                    return await session.request('get', url)
+                finally:
+                    running[0] -= 1
+            results = async_http_helper.run_all([get(i) for i in range(40)],
+                                                return_exceptions=True,
+                                                parallelism=4)
+            assert [i for i, r in enumerate(results) if isinstance(r, Exception)] == \
+                [0, 10, 20, 30]
+            assert running[1] == 4
+        finally:
+            server.shutdown()
+
+    def test_review_fingerprints_skip_unchanged_pulls(self):
+        from git_state import Repo, FQRef, FQSHA
+        from github import ReviewFingerprints
+        from pr import GitHubPR
+
+        target_ref = FQRef(Repo('hail-is', 'hail'), 'master')
+        source_ref = FQRef(Repo('danking', 'hail'), 'foo')
+
+        def gh_pr(sha, updated_at):
+            return GitHubPR('open', '1', 'foo', FQSHA(source_ref, sha), target_ref,
+                            updated_at=updated_at)
+
+        fingerprints = ReviewFingerprints()
+        assert fingerprints.get(gh_pr('a' * 40, 't1')) is None
+        fingerprints.record(gh_pr('a' * 40, 't1'), 'approved')
+        assert fingerprints.get(gh_pr('a' * 40, 't1')) == 'approved'
+        assert fingerprints.get(gh_pr('a' * 40, 't2')) is None
+        assert fingerprints.get(gh_pr('b' * 40, 't1')) is None
+        assert fingerprints.get(gh_pr('a' * 40, None)) is None
+        assert fingerprints.skipped == 1
+        assert fingerprints.fetched == 1
+
+    def test_image_cache_survives_restarts(self):
+        from image_cache import ImageCache
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'images.json')
+            images = ImageCache(2, path)
+            images.put('a', 'b', 'gcr.io/hail-vdc/hail-pr-builder:1')
+            images.put('c', 'd', None)
+            images.put('e', 'f', 'gcr.io/hail-vdc/hail-pr-builder:2')
+
+            # a crash in the middle of an append
+            with open(path, 'a') as f:
+                f.write('["g", "h", "gcr.io/hail-v')
+
+            images = ImageCache(2, path)
+            assert images.get('a', 'b') == (False, None)
+            assert images.get('c', 'd') == (True, None)
+            assert images.get('e', 'f') == (True, 'gcr.io/hail-vdc/hail-pr-builder:2')
+            assert images.get('g', 'h') == (False, None)
+            assert images.to_json()['hits'] == 2
+
+            for i in range(10):
+                images.put(str(i), str(i), None)
+            with open(path, 'r') as f:
+                assert len(f.readlines()) <= 4
+            images = ImageCache(2, path)
+            assert images.get('8', '8') == (True, None)
+            assert images.get('9', '9') == (True, None)
+
+    def test_pushed_pull_request_builds_once_its_submission_finishes(self):
+        from build_state import Building, Submitting
+        from git_state import Repo, FQRef, FQSHA
+        from pr import GitHubPR
+        from prs import PRS
+
+        target = FQSHA(FQRef(Repo('hail-is', 'hail'), 'master'), 'b' * 40)
+        source = FQSHA(FQRef(Repo('danking', 'hail'), 'foo'), 'a' * 40)
+        with FakeBuilds().installed() as builds:
+            prs = PRS({target.ref: False})
+            prs.pr_push(GitHubPR('open', '1', 'foo', source, target.ref, target.sha))
+            pr = prs._get(source.ref, target.ref)
+            assert pr.build == Submitting(target.sha)
+            assert builds.statuses == []
+
+            builds.finish(prs, 0)
+            pr = prs._get(source.ref, target.ref)
+            assert isinstance(pr.build, Building)
+            assert pr.build.job.id == 1
+            assert builds.statuses == ['pending']
+            assert builds.cancelled == []
+
+    def test_submission_for_an_old_target_is_cancelled(self):
+        from build_state import Buildable, Submitting
+        from git_state import Repo, FQRef, FQSHA
+        from pr import GitHubPR
+        from prs import PRS
+
+        target = FQSHA(FQRef(Repo('hail-is', 'hail'), 'master'), 'b' * 40)
+        new_target = FQSHA(target.ref, 'c' * 40)
+        source = FQSHA(FQRef(Repo('danking', 'hail'), 'foo'), 'a' * 40)
+        with FakeBuilds().installed() as builds:
+            prs = PRS({target.ref: False})
+            prs.pr_push(GitHubPR('open', '1', 'foo', source, target.ref, target.sha))
+            prs.push(new_target)
+            pr = prs._get(source.ref, target.ref)
+            assert pr.build == Submitting(new_target.sha)
+
+            # the job for the old target is started after the push
+            builds.finish(prs, 0)
+            assert [job.id for job in builds.cancelled] == [1]
+            pr = prs._get(source.ref, target.ref)
+            assert pr.build == Submitting(new_target.sha)
+
+            builds.finish(prs, 1)
+            pr = prs._get(source.ref, target.ref)
+            assert pr.build == Buildable('gcr.io/hail-vdc/hail-pr-builder:1', new_target.sha)
+            assert builds.statuses == ['pending']
+
+    def test_duplicate_build_submissions_are_adopted(self):
+        from build_state import Building
+        from build_submissions import BuildSubmissions
+        from git_state import Repo, FQRef, FQSHA
+        from pr import GitHubPR
+        from prs import PRS
+
+        target = FQSHA(FQRef(Repo('hail-is', 'hail'), 'master'), 'b' * 40)
+        source = FQSHA(FQRef(Repo('danking', 'hail'), 'foo'), 'a' * 40)
+
+        # a second submission of a running one is dropped
+        release = threading.Event()
+        done = threading.Event()
+        calls = []
+
+        def f(source, target):
+            calls.append((source, target))
+            release.wait()
+            return None
+
+        submissions = BuildSubmissions(2)
+        submissions.on_done = lambda source, target, build: done.set()
+        submissions.submit(source, target, f)
+        submissions.submit(source, target, f)
+        release.set()
+        assert done.wait(5)
+        assert len(calls) == 1
+        assert submissions.to_json()['duplicates'] == 1
+
+        # a batch refresh that finds the job first does not start another
+        with FakeBuilds().installed() as builds:
+            prs = PRS({target.ref: False})
+            prs.pr_push(GitHubPR('open', '1', 'foo', source, target.ref, target.sha))
+            attributes = {
+                'target': json.dumps(target.to_json()),
+                'source': json.dumps(source.to_json()),
+                'image': 'gcr.io/hail-vdc/hail-pr-builder:1'
+            }
+            prs.refresh_from_ci_job(source, target, builds.job(1, attributes))
+
+            builds.finish(prs, 0)
+            pr = prs._get(source.ref, target.ref)
+            assert isinstance(pr.build, Building)
+            assert pr.build.job.id == 1
+            assert builds.jobs == 1
+            assert builds.cancelled == []
+            assert builds.statuses == ['pending']
+
+    def test_submitting_is_unknown_after_a_restart(self):
+        from build_state import Submitting, Unknown, build_state_from_json
+
+        assert build_state_from_json(Submitting('b' * 40).to_json()) == Unknown()
+
+    def test_image_comes_from_the_merge_of_source_and_target(self):
+        import git_mirror
+        import pr
+        from git_state import Repo, FQRef, FQSHA
+        from image_cache import ImageCache
+        from shell_helper import shell
+
+        modes = [(blobless, merge_tree)
+                 for blobless in (False, True)
+                 for merge_tree in (False, True)
+                 if (not blobless or git_mirror.git_supports_blobless_mirrors()) and
+                 (not merge_tree or git_mirror.git_supports_merge_tree())]
+
+        def git(d, *args):
+            return shell('git', '-c', 'user.email=ci@example.com', '-c', 'user.name=ci',
+                         *args, cwd=d).strip()
+
+        def commit(d, filename, contents):
+            with open(os.path.join(d, filename), 'w') as f:
+                f.write(contents)
+            git(d, 'add', filename)
+            git(d, 'commit', '-m', filename)
+            return git(d, 'rev-parse', 'HEAD')
+
+        with tempfile.TemporaryDirectory() as d:
+            # like GitHub, both repos let us fetch any sha and only the
+            # blobs we need
+            upstream = os.path.join(d, 'upstream')
+            fork = os.path.join(d, 'fork')
+            git(d, 'init', '-q', upstream)
+            commit(upstream, 'hail-ci-build-image', 'gcr.io/hail-vdc/hail-pr-builder:1\n')
+            base = commit(upstream, 'README', 'a\n')
+            git(d, 'clone', '-q', upstream, fork)
+            for repo in (upstream, fork):
+                git(repo, 'config', 'uploadpack.allowAnySHA1InWant', 'true')
+                git(repo, 'config', 'uploadpack.allowFilter', 'true')
+            clean = commit(fork, 'feature', 'b\n')
+            git(fork, 'checkout', '-q', base)
+            new_image = commit(fork, 'hail-ci-build-image', 'gcr.io/hail-vdc/hail-pr-builder:2\n')
+            git(fork, 'checkout', '-q', base)
+            conflict = commit(fork, 'README', 'c\n')
+            target_sha = commit(upstream, 'README', 'd\n')
+
+            upstream_repo = Repo('hail-is', 'hail')
+            upstream_repo.url = f'file://{upstream}'
+            fork_repo = Repo('danking', 'hail')
+            fork_repo.url = f'file://{fork}'
+            target = FQSHA(FQRef(upstream_repo, 'master'), target_sha)
+
+            def source(sha):
+                return FQSHA(FQRef(fork_repo, 'foo'), sha)
+
+            old = (pr.git_mirrors, pr.image_cache, pr.merge_tree_supported)
+            try:
+                for (blobless, merge_tree) in modes:
+                    with self.subTest(blobless=blobless, merge_tree=merge_tree):
+                        pr.git_mirrors = git_mirror.GitMirrors(
+                            os.path.join(d, f'mirrors-{blobless}-{merge_tree}'), blobless)
+                        pr.image_cache = ImageCache(100)
+                        pr.merge_tree_supported = merge_tree
+                        assert pr.maybe_get_image(source(clean), target) == \
+                            'gcr.io/hail-vdc/hail-pr-builder:1'
+                        assert pr.maybe_get_image(source(new_image), target) == \
+                            'gcr.io/hail-vdc/hail-pr-builder:2'
+                        assert pr.maybe_get_image(source(conflict), target) is None
+                        assert pr.image_cache.get(conflict, target_sha) == (True, None)
+            finally:
+                (pr.git_mirrors, pr.image_cache, pr.merge_tree_supported) = old
+
+            # a remote is only pruned once nobody is reading through it
+            mirrors = git_mirror.GitMirrors(os.path.join(d, 'mirrors'), False)
+            mirrors.fetch(upstream_repo, [(fork_repo, clean)])
+            path = mirrors.path(upstream_repo)
+            with mirrors.using(upstream_repo, [fork_repo]):
+                mirrors.prune_remotes(upstream_repo, [])
+                assert 'danking/hail' in shell('git', 'remote', cwd=path).split()
+            mirrors.prune_remotes(upstream_repo, [])
+            assert shell('git', 'remote', cwd=path).split() == ['origin']
+
+    def test_incremental_refresh_keeps_pulls_updated_at_the_watermark(self):
+        import ci
+        import github
+        from git_state import Repo
+
+        target_repo = Repo('hail-is', 'hail')
+
+        def branch(owner, ref, sha):
+            return {'ref': ref, 'sha': sha, 'repo': {'name': 'hail', 'owner': {'login': owner}}}
+
+        def pull(number, updated_at, state='open'):
+            return {
+                'state': state,
+                'number': number,
+                'title': str(number),
+                'updated_at': updated_at,
+                'head': branch('danking', str(number), 'a' * 40),
+                'base': branch('hail-is', 'master', 'b' * 40)
+            }
+
+        # newest first, as GitHub sorts them
+        gh_pulls = [pull(4, '2018-06-01T12:00:03Z'),
+                    pull(3, '2018-06-01T12:00:02Z', state='closed'),
+                    pull(2, '2018-06-01T12:00:01Z'),
+                    pull(1, '2018-06-01T12:00:00Z'),
+                    pull(0, '2018-06-01T11:00:00Z')]
+        read = []
+
+        def iter_repo(repo, url, fields=None, priority=None, prefetch=True):
+            assert repo == target_repo.qname
+            for pull in gh_pulls:
+                read.append(pull['number'])
+                yield pull
+
+        old = (github.iter_repo, ci.latest_sha_for_ref, ci.fetch_review_states)
+        github.iter_repo = iter_repo
+        ci.latest_sha_for_ref = lambda ref, priority=None, fresh=False: 'c' * 40
+        ci.fetch_review_states = lambda pulls_by_target: {}
+        try:
+            snapshot = ci.fetch_changed_pulls(target_repo, '2018-06-01T12:00:01Z')
+            assert [gh_pr.number for pulls in snapshot.pulls_by_target.values()
+                    for gh_pr in pulls] == ['4', '2']
+            assert [gh_pr.number for gh_pr in snapshot.closed] == ['3']
+            assert snapshot.watermark == '2018-06-01T12:00:03Z'
+            # nothing older than the watermark is read
+            assert read == [4, 3, 2, 1]
+
+            # a pull updated at exactly the watermark is seen again, and the
+            # watermark stays where it is rather than moving past it
+            gh_pulls = gh_pulls[:1]
+            snapshot = ci.fetch_changed_pulls(target_repo, '2018-06-01T12:00:03Z')
+            assert [gh_pr.number for pulls in snapshot.pulls_by_target.values()
+                    for gh_pr in pulls] == ['4']
+            assert snapshot.watermark == '2018-06-01T12:00:03Z'
+
+            gh_pulls = []
+            snapshot = ci.fetch_changed_pulls(target_repo, '2018-06-01T12:00:03Z')
+            assert snapshot.watermark == '2018-06-01T12:00:03Z'
+        finally:
+            (github.iter_repo, ci.latest_sha_for_ref, ci.fetch_review_states) = old
+
+    def test_project_keeps_only_the_requested_fields(self):
+        from http_helper import project
+
+        pull = {
+            'number': 1,
+            'title': 'foo',
+            'body': 'a long description',
+            'head': {'ref': 'bar', 'sha': 'a' * 40, 'repo': None, 'user': {'login': 'danking'}},
+        }
+        fields = {
+            'number': None,
+            'state': None,
+            'head': {'ref': None, 'repo': {'name': None}, 'label': None}
+        }
+        assert project(pull, fields) == {
+            'number': 1,
+            'head': {'ref': 'bar', 'repo': None}
+        }
+        assert project(None, fields) is None
+        assert project({}, fields) == {}
+
+    def test_page_urls_cover_every_page_through_the_last(self):
+        from async_http_helper import page_urls
+
+        url = 'https://api.github.com/repos/hail-is/hail/pulls?state=open&per_page=100&page='
+        assert page_urls(url + '2', url + '4') == [url + '2', url + '3', url + '4']
+        assert page_urls(url + '3', url + '3') == [url + '3']
+        # GitHub does not promise where page goes in the query
+        assert page_urls(
+            'https://api.github.com/repositories/1/pulls?page=2&per_page=100',
+            'https://api.github.com/repositories/1/pulls?per_page=100&page=3') == [
+                'https://api.github.com/repositories/1/pulls?page=2&per_page=100',
+                'https://api.github.com/repositories/1/pulls?page=3&per_page=100'
+            ]
+
 
 class TestCIAgainstGitHub(unittest.TestCase):
     def get_pr(self, source_ref):